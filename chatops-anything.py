@@ -1,26 +1,1240 @@
+from abc import ABC
+from abc import abstractmethod
+from collections import deque
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import glob
 from hashlib import md5
 import itertools
+import math
 import os
 from pathlib import Path
+import random
+import re
+import shlex
+from shutil import move
 from shutil import rmtree
+import signal
 import stat
 from tempfile import gettempdir
+import threading
+import time
+from typing import Callable
 from typing import Dict
 from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Tuple
+from typing import Union
 from urllib.parse import urlparse
+from uuid import uuid4
 
 import delegator
 from errbot.backends.base import Message as ErrbotMessage
+from errbot import arg_botcmd
+from errbot import botcmd
 from errbot import BotPlugin
 from errbot import Command
 from errbot import ValidationException
 import json
+from pexpect.exceptions import EOF as PexpectEOF
 import requests
 import yaml
 
+# schema for a single command config after _load_exec_configs has collapsed it. Keys map to the types we will accept
+# for them. Anything not in here is treated as a typo and rejected at activation
+COMMAND_CONFIG_SCHEMA = {
+    'bin_path': (str, Path),
+    'url': (str,),
+    'help': (str,),
+    'timeout': (int, float, str),
+    'env_vars': (dict,),
+    'aliases': (list,),
+    'category': (str,),
+    'args': (dict,),
+    'fan_out': (bool, dict),
+    'filters': (str, list),
+}
+# keys allowed in a command config's args schema, and in each of its positional entries
+ARGS_CONFIG_KEYS = ('max_length', 'positional', 'allow_extra')
+POSITIONAL_CONFIG_KEYS = ('name', 'pattern', 'choices', 'type', 'min', 'max', 'max_length', 'required', 'repeat')
+POSITIONAL_TYPES = {'str': str, 'int': int, 'float': float}
+# keys allowed in a command config's fan_out section, and their defaults
+FAN_OUT_DEFAULTS = {'width': 10, 'common_args': 0, 'failure_lines': 3}
+# bump this when the layout of the warm restart state file changes, older state files are then ignored
+STATE_VERSION = 1
+# types we will accept as values of env_vars. They all get converted to str as that is all the environment can hold
+ENV_VAR_VALUE_TYPES = (str, int, float, bool)
+# category used for any command that doesn't set one in its config
+DEFAULT_CATEGORY = "uncategorized"
+# most characters of a command's output we take at once, and how long we wait before checking again when there's none
+OUTPUT_READ_SIZE = 65536
+OUTPUT_POLL_INTERVAL = 0.01
+
+
+class CommandSpec:
+    """
+    Compiled, read-only config for a single chatops command. Built once at activation by
+    ChatOpsAnything._compile_command_spec so run_command doesn't have to do any lookups or fallbacks
+    """
+    __slots__ = ('name', 'bin_path', 'help', 'timeout', 'env_vars', 'aliases', 'category', 'arguments', 'fan_out',
+                 'filters')
+
+    def __init__(self, name: str, bin_path: Path, help: str, timeout: float, env_vars: Dict = None,
+                 aliases: Tuple[str, ...] = (), category: str = DEFAULT_CATEGORY,
+                 arguments: 'ArgumentSpec' = None, fan_out: 'FanOutSpec' = None,
+                 filters: 'OutputPipeline' = None) -> None:
+        """
+        Sets all our fields. After this the spec can not be changed
+        Args:
+            name (str): canonical name of the command
+            bin_path (Path): path to the executable to run
+            help (str): help text for the command
+            timeout (float): seconds to wait for the command to execute
+            env_vars (Dict): extra environment variables to inject, or None for no extras
+            aliases (Tuple[str, ...]): canonical names of any other commands that run this one
+            category (str): category to group this command under in search results
+            arguments (ArgumentSpec): compiled argument schema, or None to pass any arguments through
+            fan_out (FanOutSpec): how to run the command once per target, or None to run it once
+            filters (OutputPipeline): filters to run the command's output through. None for no filters
+        """
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'bin_path', bin_path)
+        object.__setattr__(self, 'help', help)
+        object.__setattr__(self, 'timeout', timeout)
+        object.__setattr__(self, 'env_vars', env_vars)
+        object.__setattr__(self, 'aliases', aliases)
+        object.__setattr__(self, 'category', category)
+        object.__setattr__(self, 'arguments', arguments)
+        object.__setattr__(self, 'fan_out', fan_out)
+        object.__setattr__(self, 'filters', filters if filters is not None else OutputPipeline())
+
+    def __setattr__(self, key, value) -> None:
+        raise AttributeError(f"CommandSpec is read-only, can not set {key}")
+
+    def __delattr__(self, key) -> None:
+        raise AttributeError(f"CommandSpec is read-only, can not delete {key}")
+
+    def __repr__(self) -> str:
+        return f"<CommandSpec {self.name} {self.bin_path}>"
+
+
+class PositionalArgument:
+    """
+    Compiled matcher for one positional argument from a command's args schema
+    """
+    __slots__ = ('name', 'pattern', 'choices', 'number_type', 'minimum', 'maximum', 'max_length', 'required', 'repeat')
+
+    def __init__(self, name: str, pattern: Optional[Pattern] = None, choices: Optional[frozenset] = None,
+                 number_type: Optional[type] = None, minimum: Optional[float] = None, maximum: Optional[float] = None,
+                 max_length: Optional[int] = None, required: bool = True, repeat: bool = False) -> None:
+        """
+        Args:
+            name (str): name of the argument, used in usage hints
+            pattern (Pattern): regex the whole argument has to match
+            choices (frozenset): the only values the argument can have
+            number_type (type): int or float if the argument has to be a number
+            minimum (float): smallest number allowed
+            maximum (float): biggest number allowed
+            max_length (int): longest the argument can be
+            required (bool): if False, the argument can be left off
+            repeat (bool): if True, this argument can be given more than once. Only allowed on the last argument
+        """
+        self.name = name
+        self.pattern = pattern
+        self.choices = choices
+        self.number_type = number_type
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_length = max_length
+        self.required = required
+        self.repeat = repeat
+
+    def check(self, value: str) -> Optional[str]:
+        """
+        Checks a single value against this argument
+        Args:
+            value (str): value the user passed
+
+        Returns:
+            str - why the value is invalid, None if it is valid
+        """
+        if self.max_length is not None and len(value) > self.max_length:
+            return f"{self.name} can be at most {self.max_length} characters"
+        if self.choices is not None and value not in self.choices:
+            return f"{self.name} must be one of {', '.join(sorted(self.choices))}"
+        if self.pattern is not None and self.pattern.fullmatch(value) is None:
+            return f"{self.name} {value} does not match {self.pattern.pattern}"
+        if self.number_type is not None:
+            try:
+                number = self.number_type(value)
+            except ValueError:
+                return f"{self.name} must be a number ({self.number_type.__name__})"
+            # float() happily parses nan and inf, which slip past min and max
+            if not math.isfinite(number):
+                return f"{self.name} must be a finite number"
+            if self.minimum is not None and number < self.minimum:
+                return f"{self.name} must be at least {self.minimum}"
+            if self.maximum is not None and number > self.maximum:
+                return f"{self.name} must be at most {self.maximum}"
+        return None
+
+    @property
+    def usage(self) -> str:
+        name = "|".join(sorted(self.choices)) if self.choices is not None else self.name
+        usage = f"<{name}>" if self.required else f"[{name}]"
+        return f"{usage}..." if self.repeat else usage
+
+
+class ArgumentSpec:
+    """
+    Compiled args schema for a command. Lets run_command turn away bad arguments without spawning a process
+    """
+    __slots__ = ('max_length', 'positionals', 'allow_extra', 'usage')
+
+    def __init__(self, positionals: Tuple[PositionalArgument, ...] = (), max_length: Optional[int] = None,
+                 allow_extra: bool = False) -> None:
+        """
+        Args:
+            positionals (Tuple[PositionalArgument, ...]): matchers for each positional argument, in order
+            max_length (int): longest the whole argument string can be
+            allow_extra (bool): if True, arguments past the last positional are passed through unchecked
+        """
+        self.positionals = positionals
+        self.max_length = max_length
+        self.allow_extra = allow_extra
+        self.usage = " ".join([positional.usage for positional in positionals] + (["..."] if allow_extra else []))
+
+    def check(self, args: str) -> Optional[str]:
+        """
+        Checks the arguments a user passed against the schema
+        Args:
+            args (str): arguments from chatops
+
+        Returns:
+            str - why the arguments are invalid, None if they are valid
+        """
+        if self.max_length is not None and len(args) > self.max_length:
+            return f"arguments can be at most {self.max_length} characters"
+        try:
+            # split the way the shell delegator hands them to will
+            values = shlex.split(args)
+        except ValueError as error:
+            return f"unable to parse arguments, {error}"
+
+        for index, positional in enumerate(self.positionals):
+            if index >= len(values):
+                if positional.required:
+                    return f"missing {positional.name}"
+                return None
+            to_check = values[index:] if positional.repeat else [values[index]]
+            for value in to_check:
+                error = positional.check(value)
+                if error is not None:
+                    return error
+
+        if self.positionals and self.positionals[-1].repeat:
+            return None
+        if len(values) > len(self.positionals) and not self.allow_extra:
+            return f"too many arguments, expected at most {len(self.positionals)}"
+        return None
+
+
+class FanOutSpec:
+    """
+    Compiled fan_out config for a command. The first common_args arguments are passed to every child and each
+    argument after them is a target that gets its own child process
+    """
+    __slots__ = ('width', 'common_args', 'failure_lines')
+
+    def __init__(self, width: int, common_args: int, failure_lines: int) -> None:
+        """
+        Args:
+            width (int): most children to run at once
+            common_args (int): number of leading arguments passed to every child
+            failure_lines (int): lines of output to show for each failed target
+        """
+        self.width = width
+        self.common_args = common_args
+        self.failure_lines = failure_lines
+
+
+class OutputPipeline:
+    """
+    Chain of streaming filters a command's output goes through before it is sent to chat. Each stage is a generator
+    over lines of output, so only what a stage needs to remember (i.e. the last lines for tail) is held in memory.
+    Filters are written like shell pipes, i.e. "grep -v DEBUG | head 20"
+    """
+    __slots__ = ('stages', 'description')
+
+    # [n], [*] or [] and .key or ['key'] steps of a json path like $.items[*].name
+    JSON_PATH_REGEX = re.compile(r"\.([^.\[\]]+)|\[(-?\d+|\*)?\]|\['([^']*)'\]")
+
+    def __init__(self, stages: Tuple[Callable[[Iterable[str]], Iterator[str]], ...] = (),
+                 description: str = "") -> None:
+        """
+        Args:
+            stages (Tuple[Callable, ...]): generator functions that each take and return an iterable of lines
+            description (str): the filters the stages were compiled from
+        """
+        self.stages = stages
+        self.description = description
+
+    def __bool__(self) -> bool:
+        return bool(self.stages)
+
+    def __add__(self, other: 'OutputPipeline') -> 'OutputPipeline':
+        return OutputPipeline(self.stages + other.stages,
+                              " | ".join(pipeline.description for pipeline in [self, other] if pipeline.description))
+
+    def apply(self, lines: Iterable[str]) -> Iterable[str]:
+        """
+        Runs lines through every stage
+        Args:
+            lines (Iterable[str]): lines of output, with their line endings
+
+        Returns:
+            Iterable[str] - filtered lines
+        """
+        for stage in self.stages:
+            lines = stage(lines)
+        return lines
+
+    @staticmethod
+    def split_pipes(text: str) -> List[str]:
+        """
+        Splits text on any | that isn't quoted or escaped
+        Args:
+            text (str): text to split
+
+        Returns:
+            List[str] - each piece of text, stripped of whitespace
+        """
+        pieces = list()
+        current = list()
+        quote = None
+        escaped = False
+        for char in text:
+            if escaped:
+                escaped = False
+            elif char == "\\" and quote != "'":
+                escaped = True
+            elif quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in "'\"":
+                quote = char
+            elif char == "|":
+                pieces.append("".join(current).strip())
+                current = list()
+                continue
+            current.append(char)
+        pieces.append("".join(current).strip())
+        return pieces
+
+    @classmethod
+    def compile(cls, filters: Union[str, List[str]]) -> 'OutputPipeline':
+        """
+        Compiles filters into a pipeline
+        Args:
+            filters (str or List[str]): filters separated by |, or a list of them
+
+        Returns:
+            OutputPipeline - the compiled filters
+
+        Raises:
+            ValueError when a filter is invalid
+        """
+        if isinstance(filters, str):
+            filters = cls.split_pipes(filters)
+        stages = list()
+        for text in filters:
+            if not isinstance(text, str):
+                raise ValueError(f"filter {text} must be a str")
+            try:
+                argv = shlex.split(text)
+            except ValueError as error:
+                raise ValueError(f"unable to parse filter {text}, {error}")
+            if not argv:
+                raise ValueError("empty filter")
+            builder = getattr(cls, f"_{argv[0]}_stage", None)
+            if argv[0] not in OUTPUT_FILTERS or builder is None:
+                raise ValueError(f"unknown filter {argv[0]}. Filters are {', '.join(OUTPUT_FILTERS)}")
+            stages.append(builder(argv[1:]))
+        return cls(tuple(stages), " | ".join(filters))
+
+    @staticmethod
+    def _count(argv: List[str], name: str, default: int) -> int:
+        if len(argv) > 1:
+            raise ValueError(f"{name} takes at most one argument")
+        if not argv:
+            return default
+        if not argv[0].isdigit():
+            raise ValueError(f"{name} takes a number of lines, not {argv[0]}")
+        return int(argv[0])
+
+    @staticmethod
+    def _grep_stage(argv: List[str]) -> Callable[[Iterable[str]], Iterator[str]]:
+        """
+        grep [-i] [-v] PATTERN - keeps lines matching the PATTERN regex. -i ignores case, -v keeps lines that
+        don't match
+        """
+        flags = 0
+        invert = False
+        while argv and argv[0].startswith("-") and len(argv) > 1:
+            for flag in argv[0][1:]:
+                if flag == "i":
+                    flags |= re.IGNORECASE
+                elif flag == "v":
+                    invert = True
+                else:
+                    raise ValueError(f"unknown grep option -{flag}")
+            argv = argv[1:]
+        if len(argv) != 1:
+            raise ValueError("grep takes one pattern")
+        try:
+            pattern = re.compile(argv[0], flags)
+        except re.error as error:
+            raise ValueError(f"grep pattern {argv[0]} is not a valid regex. {error}")
+
+        def grep(lines: Iterable[str]) -> Iterator[str]:
+            for line in lines:
+                if (pattern.search(line) is None) == invert:
+                    yield line
+        return grep
+
+    @classmethod
+    def _head_stage(cls, argv: List[str]) -> Callable[[Iterable[str]], Iterator[str]]:
+        """
+        head [N] - keeps the first N lines, 10 by default
+        """
+        count = cls._count(argv, "head", 10)
+
+        def head(lines: Iterable[str]) -> Iterator[str]:
+            for index, line in enumerate(lines):
+                # keep reading after we have enough so the child doesn't back up, we just don't hold on to it
+                if index < count:
+                    yield line
+        return head
+
+    @classmethod
+    def _tail_stage(cls, argv: List[str]) -> Callable[[Iterable[str]], Iterator[str]]:
+        """
+        tail [N] - keeps the last N lines, 10 by default
+        """
+        count = cls._count(argv, "tail", 10)
+
+        def tail(lines: Iterable[str]) -> Iterator[str]:
+            yield from deque(lines, maxlen=count)
+        return tail
+
+    @staticmethod
+    def _uniq_stage(argv: List[str]) -> Callable[[Iterable[str]], Iterator[str]]:
+        """
+        uniq - drops repeated lines, prefixing each line with how many times it was seen
+        """
+        if argv:
+            raise ValueError("uniq takes no arguments")
+
+        def uniq(lines: Iterable[str]) -> Iterator[str]:
+            counts = dict()  # typing: Dict[str, int], dicts keep the order lines were first seen in
+            for line in lines:
+                line = line.rstrip("\r\n")
+                counts[line] = counts.get(line, 0) + 1
+            for line, count in counts.items():
+                yield f"{count:>4} {line}\n"
+        return uniq
+
+    @classmethod
+    def _json_stage(cls, argv: List[str]) -> Callable[[Iterable[str]], Iterator[str]]:
+        """
+        json PATH - parses the output as json, or as a json document per line, and keeps the values at PATH. PATH
+        looks like $.items[*].name
+        """
+        if len(argv) != 1:
+            raise ValueError("json takes one path, like $.items[*].name")
+        path = argv[0][1:] if argv[0].startswith("$") else argv[0]
+        steps = list()
+        position = 0
+        while position < len(path):
+            match = cls.JSON_PATH_REGEX.match(path, position)
+            if match is None:
+                raise ValueError(f"invalid json path {argv[0]} at {path[position:]}")
+            key, index, quoted_key = match.groups()
+            if key is not None or quoted_key is not None:
+                steps.append(key if key is not None else quoted_key)
+            else:
+                steps.append(None if index in (None, "*") else int(index))
+            position = match.end()
+
+        def select(document) -> Iterator:
+            values = [document]
+            for step in steps:
+                selected = list()
+                for value in values:
+                    if step is None:
+                        if isinstance(value, list):
+                            selected.extend(value)
+                        elif isinstance(value, dict):
+                            selected.extend(value.values())
+                    elif isinstance(step, int):
+                        if isinstance(value, list) and -len(value) <= step < len(value):
+                            selected.append(value[step])
+                    elif isinstance(value, dict) and step in value:
+                        selected.append(value[step])
+                values = selected
+            return values
+
+        def extract(lines: Iterable[str]) -> Iterator[str]:
+            lines = list(lines)
+            try:
+                documents = [json.loads("".join(lines))]
+            except ValueError:
+                try:
+                    documents = [json.loads(line) for line in lines if line.strip()]
+                except ValueError as error:
+                    yield f"Unable to parse output as json. {error}\n"
+                    return
+            for document in documents:
+                for value in select(document):
+                    yield (value if isinstance(value, str) else json.dumps(value)) + "\n"
+        return extract
+
+    @staticmethod
+    def _cols_stage(argv: List[str]) -> Callable[[Iterable[str]], Iterator[str]]:
+        """
+        cols [-d DELIMITER] N[,N...] - keeps the given columns of each line, counting from 1. Columns are split on
+        whitespace unless a delimiter is given
+        """
+        delimiter = None
+        if len(argv) == 3 and argv[0] == "-d":
+            delimiter = argv[1]
+            argv = argv[2:]
+            if not delimiter:
+                # str.split("") raises, catch it here rather than on the first line of output
+                raise ValueError("cols -d needs a delimiter of at least one character")
+        if len(argv) != 1:
+            raise ValueError("cols takes a comma separated list of columns, like 1,3")
+        try:
+            columns = [int(column) - 1 for column in argv[0].split(",")]
+        except ValueError:
+            raise ValueError(f"cols {argv[0]} is not a comma separated list of numbers")
+        if any(column < 0 for column in columns):
+            raise ValueError("cols are counted from 1")
+        joiner = delimiter if delimiter is not None else " "
+
+        def cols(lines: Iterable[str]) -> Iterator[str]:
+            for line in lines:
+                fields = line.rstrip("\r\n").split(delimiter)
+                yield joiner.join(fields[column] for column in columns if column < len(fields)) + "\n"
+        return cols
+
+
+# names of the filters OutputPipeline knows about, in the order we list them to users
+OUTPUT_FILTERS = ('grep', 'head', 'tail', 'uniq', 'json', 'cols')
+
+
+class CommandIndex:
+    """
+    Inverted index over our commands' names, aliases, categories and help text. Backs !cops search.
+    Commands are added and removed one at a time so the index never has to be rebuilt from scratch
+    """
+    # how much a term is worth depending on where in the command it was found
+    NAME_WEIGHT = 10
+    ALIAS_WEIGHT = 6
+    CATEGORY_WEIGHT = 3
+    HELP_WEIGHT = 1
+
+    TERM_REGEX = re.compile(r"[a-z0-9]+")
+
+    def __init__(self) -> None:
+        # term -> {command name: weight}
+        self._postings = dict()  # typing: Dict[str, Dict[str, int]]
+        # command name -> the spec it was indexed from, so we can remove its postings or skip re-indexing it
+        self._specs = dict()  # typing: Dict[str, CommandSpec]
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._specs
+
+    def names(self) -> List[str]:
+        """
+        Returns:
+            List[str] - names of every command in the index
+        """
+        return list(self._specs.keys())
+
+    def get(self, name: str) -> CommandSpec:
+        """
+        Args:
+            name (str): command name
+
+        Returns:
+            CommandSpec - the spec indexed under name, or None
+        """
+        return self._specs.get(name, None)
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """
+        Splits text into lowercase alphanumeric terms
+        Args:
+            text (str): text to split
+
+        Returns:
+            List[str] - terms found in text
+        """
+        return cls.TERM_REGEX.findall(text.lower())
+
+    def add(self, spec: CommandSpec) -> None:
+        """
+        Adds a command to the index, replacing any earlier version of it. Adding the same spec again is a noop
+        Args:
+            spec (CommandSpec): command to index
+
+        Returns:
+            None
+        """
+        if self._specs.get(spec.name, None) is spec:
+            return
+        self.remove(spec.name)
+
+        weights = dict()  # typing: Dict[str, int]
+
+        def weigh(text: str, weight: int) -> None:
+            for term in self.tokenize(text):
+                weights[term] = weights.get(term, 0) + weight
+
+        # the whole name counts as a term too, so searching for check_disk finds check_disk first
+        weigh(spec.name, self.NAME_WEIGHT)
+        weights[spec.name] = weights.get(spec.name, 0) + self.NAME_WEIGHT
+        for alias in spec.aliases:
+            weigh(alias, self.ALIAS_WEIGHT)
+            weights[alias] = weights.get(alias, 0) + self.ALIAS_WEIGHT
+        weigh(spec.category, self.CATEGORY_WEIGHT)
+        weigh(spec.help or "", self.HELP_WEIGHT)
+
+        for term, weight in weights.items():
+            self._postings.setdefault(term, dict())[spec.name] = weight
+        self._specs[spec.name] = spec
+
+    def remove(self, name: str) -> None:
+        """
+        Removes a command from the index. Removing a command that isn't indexed is a noop
+        Args:
+            name (str): name of the command to remove
+
+        Returns:
+            None
+        """
+        spec = self._specs.pop(name, None)
+        if spec is None:
+            return
+        terms = set(self.tokenize(" ".join([spec.name, spec.category, spec.help or ""] + list(spec.aliases))))
+        terms.add(spec.name)
+        terms.update(spec.aliases)
+        for term in terms:
+            postings = self._postings.get(term, None)
+            if postings is None:
+                continue
+            postings.pop(name, None)
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query: str) -> List[Tuple[CommandSpec, int]]:
+        """
+        Finds every command that matches any term in query. Each matching term adds its weight to the command's
+        score, so commands matching more terms, or matching them in their name, rank first
+        Args:
+            query (str): search terms, separated by whitespace
+
+        Returns:
+            List[Tuple[CommandSpec, int]] - matching commands and their scores, best match first
+        """
+        scores = dict()  # typing: Dict[str, int]
+        terms = set(self.tokenize(query))
+        terms.update(query.lower().split())
+        for term in terms:
+            for name, weight in self._postings.get(term, dict()).items():
+                scores[name] = scores.get(name, 0) + weight
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(self._specs[name], score) for name, score in ranked]
+
+
+class Span:
+    """
+    A timed step of a traced run_command invocation. Spans are exported by their Tracer as soon as they end, so a
+    span for a send that finishes after its command still makes it out. Can be used as a context manager
+    """
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'start_time', 'end_time', 'attributes')
+    sampled = True
+
+    def __init__(self, tracer: 'Tracer', trace_id: str, parent_id: Optional[str], name: str,
+                 attributes: Dict) -> None:
+        """
+        Args:
+            tracer (Tracer): tracer that exports this span
+            trace_id (str): id shared by every span in the trace
+            parent_id (str): span_id of our parent, None for the root span
+            name (str): what this span is timing
+            attributes (Dict): extra info about the span, i.e. command, pid, bytes, rc
+        """
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.start_time = time.time()
+        self.end_time = None
+        self.attributes = attributes
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_value is not None:
+            self.set_attribute('error', repr(exc_value))
+        self.end()
+
+    def child(self, name: str, **attributes) -> 'Span':
+        """
+        Starts a new span under this one
+        Args:
+            name (str): what the new span is timing
+            **attributes: attributes for the new span
+
+        Returns:
+            Span - the started child span
+        """
+        return Span(self.tracer, self.trace_id, self.span_id, name, attributes)
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        """
+        Ends the span and exports it. Ending a span more than once does nothing
+        Returns:
+            None
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        self.tracer.export(self)
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    def to_dict(self) -> Dict:
+        """
+        Returns:
+            Dict - the span as something we can serialize
+        """
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'start_time': self.start_time, 'end_time': self.end_time, 'duration': self.duration,
+                'attributes': self.attributes}
+
+
+class NoopSpan:
+    """
+    Stands in for a Span when a trace isn't sampled. Every method is a noop so unsampled invocations cost next to
+    nothing
+    """
+    __slots__ = ()
+    sampled = False
+
+    def __enter__(self) -> 'NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+    def child(self, name: str, **attributes) -> 'NoopSpan':
+        return self
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanExporter(ABC):
+    """
+    Base class for span exporters. Subclass it, implement export and add it with Tracer.add_exporter to send spans
+    somewhere new
+    """
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        """
+        Called with each span as it ends
+        Args:
+            span (Span): the finished span
+
+        Returns:
+            None
+        """
+
+    def shutdown(self) -> None:
+        """
+        Called when the tracer shuts down. Release anything the exporter holds open here
+        Returns:
+            None
+        """
+        pass
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """
+    Exports spans to a file, one json object per line
+    """
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): file to append spans to
+        """
+        self.path = Path(path)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Tracer:
+    """
+    Starts traces for run_command invocations and hands their spans to our exporters. Only sample_rate of traces are
+    recorded, the rest get a NoopSpan. With no exporters nothing is recorded at all
+    """
+    def __init__(self, sample_rate: float = 1.0, log=None) -> None:
+        """
+        Args:
+            sample_rate (float): fraction of traces to record, from 0 to 1
+            log: logger to report exporter errors to
+        """
+        self.sample_rate = sample_rate
+        self.log = log
+        self._exporters = list()  # typing: List[SpanExporter]
+
+    def add_exporter(self, exporter: SpanExporter) -> None:
+        self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter: SpanExporter) -> None:
+        self._exporters.remove(exporter)
+
+    def start_trace(self, name: str, **attributes):
+        """
+        Starts a new trace, if this one is sampled
+        Args:
+            name (str): name of the root span
+            **attributes: attributes for the root span
+
+        Returns:
+            Span or NoopSpan - the root span of the trace
+        """
+        if not self._exporters or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(self, uuid4().hex, None, name, attributes)
+
+    def export(self, span: Span) -> None:
+        """
+        Hands a finished span to every exporter. A broken exporter is logged and doesn't stop the others
+        Args:
+            span (Span): finished span
+
+        Returns:
+            None
+        """
+        for exporter in list(self._exporters):
+            try:
+                exporter.export(span)
+            except Exception as error:
+                # exporters are pluggable, so this is broad on purpose. Tracing should never break a command
+                if self.log is not None:
+                    self.log.exception(f"Exporter {exporter} failed to export span {span.name}. {error}")
+
+    def shutdown(self) -> None:
+        """
+        Shuts down and removes every exporter
+        Returns:
+            None
+        """
+        for exporter in self._exporters:
+            try:
+                exporter.shutdown()
+            except Exception as error:
+                if self.log is not None:
+                    self.log.exception(f"Exporter {exporter} failed to shutdown. {error}")
+        self._exporters = list()
+
+
+class TokenBucket:
+    """
+    Token bucket used to pace our sends to the chat backend. Holds up to capacity tokens and refills at rate tokens
+    per second
+    """
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        Args:
+            rate (float): tokens added per second, greater than 0
+            capacity (float): most tokens the bucket can hold, i.e. the biggest burst we allow. At least 1
+
+        Raises:
+            ValueError when rate or capacity would leave us never able to take a token
+        """
+        if rate <= 0:
+            raise ValueError(f"rate must be greater than 0, got {rate}")
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, got {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes a token from the bucket, sleeping until one is available
+        Returns:
+            float - seconds spent waiting for a token
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class OutboundMessage:
+    """
+    A message waiting in the OutboundQueue. parts holds every text coalesced into it, in order, and spans holds a
+    send span for each of them
+    """
+    __slots__ = ('to', 'in_reply_to', 'parts', 'size', 'enqueued_at', 'spans')
+
+    def __init__(self, to, in_reply_to: Optional[ErrbotMessage], text: str, span=NOOP_SPAN) -> None:
+        self.to = to
+        self.in_reply_to = in_reply_to
+        self.parts = [text]
+        self.size = len(text)
+        self.enqueued_at = time.monotonic()
+        self.spans = [span]
+
+    def is_for(self, to, in_reply_to: Optional[ErrbotMessage]) -> bool:
+        """
+        Returns:
+            bool - True if this message goes to the same place and thread as to and in_reply_to
+        """
+        return str(self.to) == str(to) and self.in_reply_to is in_reply_to
+
+
+class OutboundQueue:
+    """
+    Central queue for everything the plugin sends to chat. A single worker thread delivers messages so commands never
+    block on the chat backend. Messages headed to the same thread while they wait are coalesced into one, bodies
+    bigger than the backend's limit are split, sends are paced with a TokenBucket and rate limited sends are retried
+    """
+    def __init__(self, send: Callable, size_limit: int, rate: float, burst: float, max_retries: int = 3,
+                 linger: float = 0.1, log=None) -> None:
+        """
+        Args:
+            send (Callable): called as send(to, text, in_reply_to=msg) to deliver a message, i.e. BotPlugin.send
+            size_limit (int): biggest message body the backend will take
+            rate (float): sustained messages per second we'll send
+            burst (float): messages we can send back to back before rate kicks in
+            max_retries (int): times to retry a send that was rate limited
+            linger (float): seconds a message waits for more text to coalesce with before it is sent
+            log: logger to report failures to
+        """
+        self._send = send
+        self.size_limit = size_limit
+        self.max_retries = max_retries
+        self.linger = linger
+        self.log = log
+        self._bucket = TokenBucket(rate, burst)
+        self._pending = deque()  # typing: Deque[OutboundMessage]
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None  # typing: threading.Thread
+        self._metrics = {'enqueued': 0, 'coalesced': 0, 'sent': 0, 'chunks': 0, 'retries': 0, 'failed': 0,
+                         'max_depth': 0, 'throttled_seconds': 0.0}
+
+    def start(self) -> None:
+        """
+        Starts the worker thread
+        Returns:
+            None
+        """
+        with self._condition:
+            self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="chatops-anything-outbound", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Sends everything still in the queue, then stops the worker thread
+        Args:
+            timeout (float): seconds to wait for the worker to finish
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def enqueue(self, to, text: str, in_reply_to: ErrbotMessage = None, span=NOOP_SPAN) -> None:
+        """
+        Queues text to be sent to to. If a message for the same thread is still waiting and there's room, text is
+        added on to it rather than sent separately. Once the queue has been stopped, text is sent right away on the
+        caller's thread so commands that outlive a deactivate still get their output to the user
+        Args:
+            to: errbot Identifier to send to
+            text (str): message body
+            in_reply_to (ErrbotMessage): message we're replying to, if any
+            span (Span): span to record a send span under. It covers the time queued and the time sending
+
+        Returns:
+            None
+        """
+        send_span = span.child("send", bytes=len(text.encode('utf-8')))
+        with self._condition:
+            self._metrics['enqueued'] += 1
+            # check and append under one hold of the lock, or a stop() in between would leave this stranded
+            stopping = self._stopping
+            if not stopping:
+                self._append(to, in_reply_to, text, send_span)
+        if stopping:
+            self._deliver_safely(OutboundMessage(to, in_reply_to, text, send_span))
+
+    def _append(self, to, in_reply_to: ErrbotMessage, text: str, send_span: Span) -> None:
+        """
+        Adds text on to a pending message for the same thread if there's room, or queues it as a new message. Must be
+        called holding self._condition
+        Args:
+            to: errbot Identifier to send to
+            in_reply_to (ErrbotMessage): message we're replying to, if any
+            text (str): message body
+            send_span (Span): send span for text
+
+        Returns:
+            None
+        """
+        for pending in reversed(self._pending):
+            if pending.is_for(to, in_reply_to):
+                if pending.size + 1 + len(text) <= self.size_limit:
+                    pending.parts.append(text)
+                    pending.size += 1 + len(text)
+                    pending.spans.append(send_span)
+                    send_span.set_attribute('coalesced', True)
+                    self._metrics['coalesced'] += 1
+                    return
+                break
+        self._pending.append(OutboundMessage(to, in_reply_to, text, send_span))
+        self._metrics['max_depth'] = max(self._metrics['max_depth'], len(self._pending))
+        self._condition.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits for everything queued so far to be sent
+        Args:
+            timeout (float): seconds to wait, None waits forever
+
+        Returns:
+            bool - True if the queue drained, False if we timed out
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and self._in_flight == 0, timeout)
+
+    def metrics(self) -> Dict:
+        """
+        Returns:
+            Dict - queue depth, messages in flight and counters for everything the queue has done
+        """
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics['depth'] = len(self._pending)
+            metrics['in_flight'] = self._in_flight
+        return metrics
+
+    @staticmethod
+    def split_text(text: str, size_limit: int) -> List[str]:
+        """
+        Splits text into chunks no bigger than size_limit, breaking on newlines where we can
+        Args:
+            text (str): text to split
+            size_limit (int): biggest chunk we can send
+
+        Returns:
+            List[str] - chunks of text
+        """
+        if len(text) <= size_limit:
+            return [text]
+        chunks = list()
+        current = ""
+        for line in text.split("\n"):
+            # a single line that's too long has to be cut up on its own
+            while len(line) > size_limit:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(line[:size_limit])
+                line = line[size_limit:]
+            if current and len(current) + 1 + len(line) > size_limit:
+                chunks.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    @staticmethod
+    def is_rate_limited(error: Exception) -> bool:
+        """
+        Guesses if an exception from a backend means we were rate limited. Backends don't agree on how to say this, so
+        we look for a 429 status or rate limit in the error
+        Args:
+            error (Exception): exception raised by a send
+
+        Returns:
+            bool - True if the send should be retried
+        """
+        response = getattr(error, 'response', None)
+        for status in [getattr(error, 'status', None), getattr(error, 'status_code', None),
+                       getattr(response, 'status_code', None), getattr(response, 'status', None)]:
+            if status == 429 or status == "429":
+                return True
+        message = str(error).lower()
+        return "429" in message or "rate limit" in message or "ratelimit" in message or "ratelimited" in message
+
+    def _run(self) -> None:
+        """
+        Worker thread. Takes messages off the queue once they've lingered and delivers them
+        Returns:
+            None
+        """
+        while True:
+            with self._condition:
+                if not self._pending:
+                    if self._stopping:
+                        return
+                    self._condition.wait()
+                    continue
+                # give anything else headed to this thread a chance to join the message, unless we're shutting down
+                wait = self._pending[0].enqueued_at + self.linger - time.monotonic()
+                if wait > 0 and not self._stopping:
+                    self._condition.wait(wait)
+                    continue
+                message = self._pending.popleft()
+                self._in_flight += 1
+            try:
+                self._deliver_safely(message)
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _deliver_safely(self, message: OutboundMessage) -> None:
+        """
+        Calls _deliver, logging and counting anything it raises so a single bad message can't kill the worker thread
+        Args:
+            message (OutboundMessage): message to send
+
+        Returns:
+            None
+        """
+        try:
+            self._deliver(message)
+        except Exception as error:
+            # this is a VERY broad except, but the worker has to keep running for every message after this one
+            if self.log is not None:
+                self.log.exception(f"Error delivering message to {message.to}. {error}")
+            with self._condition:
+                self._metrics['failed'] += 1
+            for span in message.spans:
+                span.set_attribute('error', repr(error))
+                span.end()
+
+    def _deliver(self, message: OutboundMessage) -> None:
+        """
+        Sends a message, split into chunks the backend can take, retrying any chunk that gets rate limited
+        Args:
+            message (OutboundMessage): message to send
+
+        Returns:
+            None
+        """
+        text = "\n".join(part for part in message.parts if part)
+        chunks = self.split_text(text, self.size_limit)
+        retries = 0
+        failed = 0
+        for chunk in chunks:
+            for attempt in range(self.max_retries + 1):
+                waited = self._bucket.acquire()
+                try:
+                    self._send(message.to, text=chunk, in_reply_to=message.in_reply_to)
+                except Exception as error:
+                    # Backends raise all sorts of things, so this is broad on purpose
+                    if self.is_rate_limited(error) and attempt < self.max_retries:
+                        retry_after = getattr(error, 'retry_after', None) or 2 ** attempt
+                        if self.log is not None:
+                            self.log.info(f"Rate limited sending to {message.to}. Retrying in {retry_after}s")
+                        retries += 1
+                        with self._condition:
+                            self._metrics['retries'] += 1
+                        time.sleep(float(retry_after))
+                        continue
+                    if self.log is not None:
+                        self.log.exception(f"Unable to send message to {message.to}. {error}")
+                    failed += 1
+                    with self._condition:
+                        self._metrics['failed'] += 1
+                    break
+                with self._condition:
+                    self._metrics['chunks'] += 1
+                    self._metrics['throttled_seconds'] += waited
+                break
+        with self._condition:
+            self._metrics['sent'] += 1
+        for span in message.spans:
+            span.set_attribute('chunks', len(chunks))
+            span.set_attribute('retries', retries)
+            span.set_attribute('failed', failed)
+            span.end()
+
 
 class ChatOpsAnything(BotPlugin):
     """ChatOpsAnything is an errbot plugin to allow plain executables in a directory be run via chatops"""
@@ -35,7 +1249,15 @@ class ChatOpsAnything(BotPlugin):
         self.BIN_PATH = None  # typing: Path
         self.CONFIG_PATH = None  # typing: Path
         self.TEMP_PATH = None  # typing: Path
-        self.EXECUTABLE_CONFIGS = {}  # typing: Dict
+        self.EXECUTABLE_CONFIGS = {}  # typing: Dict[str, CommandSpec]
+        # COMMAND_INDEX outlives deactivate so a reactivation only has to index what changed
+        self.COMMAND_INDEX = CommandIndex()
+        self.OUTBOUND_QUEUE = None  # typing: OutboundQueue
+        self.TRACER = None  # typing: Tracer
+        # CHECKPOINT is the warm state loaded from STATE_PATH on activate, RESOLVED_STATE is what this activation
+        # probed and downloaded, saved to STATE_PATH on deactivate
+        self.CHECKPOINT = self._empty_state()  # typing: Dict
+        self.RESOLVED_STATE = self._empty_state()  # typing: Dict
         self.log.debug("Done with init")
 
     # botplugin methods, these are not commands and just configure/setup our plugin
@@ -50,6 +1272,13 @@ class ChatOpsAnything(BotPlugin):
                        f"TEMP_PATH {self.config['TEMP_PATH']}")
 
         self.TEMP_PATH = Path(self.config['TEMP_PATH'])
+        # anything in the checkpoint that still matches the filesystem saves us a download or a help probe
+        self.CHECKPOINT = self._load_checkpoint()
+        if not self.config['WARM_RESTART']:
+            # we won't reuse anything, but the last activation may have left its tempdir behind for us to clean up
+            self.CHECKPOINT = dict(self._empty_state(), temp_path=self.CHECKPOINT['temp_path'],
+                                   tmp_cleanup=self.CHECKPOINT['tmp_cleanup'])
+        self.RESOLVED_STATE = self._empty_state()
         exec_configs = {}
         if self.config['CONFIG_PATH'] is not None:
             self.CONFIG_PATH = Path(self.config['CONFIG_PATH'])
@@ -69,22 +1298,64 @@ class ChatOpsAnything(BotPlugin):
                 self.log.debug(f"{executable} has no config file and is not excluded, adding it now")
                 exec_configs[name] = dict()
                 exec_configs[name]['bin_path'] = executable
-                exec_configs[name]['help'] = self._get_help(executable)
+                exec_configs[name]['help'] = self._probe_help(executable)
 
         self.log.debug(f"{len(exec_configs.keys())} configs total")
-        self.EXECUTABLE_CONFIGS = exec_configs
+        # validate and compile every config into a CommandSpec. A bad config raises ValidationException here so we
+        # fail at activation rather than when someone tries to run the command
+        command_specs = dict()
+        for name, exec_config in exec_configs.items():
+            if 'help' not in exec_config:
+                exec_config['help'] = self._probe_help(exec_config['bin_path'])
+            command_specs[name] = self._compile_command_spec(name, exec_config)
+
+        # aliases run the same spec as their command, so they get their own key pointing at it
+        for command_spec in list(command_specs.values()):
+            for alias in command_spec.aliases:
+                if alias in command_specs:
+                    raise ValidationException(f"Chatops Anything: Alias {alias} for {command_spec.name} is already "
+                                              f"defined as a command or alias")
+                command_specs[alias] = command_spec
+        self.EXECUTABLE_CONFIGS = command_specs
+        self._update_command_index(command_specs)
 
         # commands is a list of our
         commands = list()
-        for command in exec_configs.keys():
-            if 'help' not in exec_configs[command]:
-                exec_configs[command]['help'] = self._get_help(exec_configs[command]['bin_path'])
+        for name, command_spec in command_specs.items():
             # create a new command for the bot
-            self.log.debug(f"Creating new command for {command}")
+            self.log.debug(f"Creating new command for {name}")
+            doc = command_spec.help if name == command_spec.name else f"Alias for {command_spec.name}"
             commands.append(Command(lambda plugin, msg, args: self.run_command(msg, args),
-                                    name=command, doc=exec_configs[command]['help']))
-        # create a dynamic plugin for all of our executables
-        self.create_dynamic_plugin(self.config['PLUGIN_NAME'], tuple(commands))
+                                    name=name, doc=doc))
+        try:
+            # everything we send goes through OUTBOUND_QUEUE so commands don't block on, or flood, the chat backend
+            self.OUTBOUND_QUEUE = OutboundQueue(self.send,
+                                                size_limit=self._bot.message_size_limit,
+                                                rate=float(self.config['SEND_RATE']),
+                                                burst=float(self.config['SEND_BURST']),
+                                                max_retries=int(self.config['SEND_RETRIES']),
+                                                log=self.log)
+            # tracing is only recorded if there is an exporter. Other plugins can add their own with
+            # TRACER.add_exporter
+            self.TRACER = Tracer(sample_rate=float(self.config['TRACE_SAMPLE_RATE']), log=self.log)
+            if self.config['TRACE_PATH']:
+                self.TRACER.add_exporter(JsonLinesSpanExporter(self.config['TRACE_PATH']))
+            self.OUTBOUND_QUEUE.start()
+            # create a dynamic plugin for all of our executables
+            self.create_dynamic_plugin(self.config['PLUGIN_NAME'], tuple(commands))
+        except Exception:
+            # errbot won't call deactivate after a failed activate, so stop anything we got as far as starting here
+            self._stop_delivery()
+            raise
+
+        # any downloads we reused have been moved out of the last activation's tempdir, so it can go now
+        old_temp_path = self.CHECKPOINT['temp_path']
+        if old_temp_path is not None and Path(old_temp_path) != self.TEMP_PATH and self.CHECKPOINT['tmp_cleanup']:
+            self._cleanup_tempdir(old_temp_path)
+        if not self.config['WARM_RESTART'] and old_temp_path is not None:
+            # nothing will use the checkpoint now, don't leave it pointing at a tempdir that's gone
+            self._remove_checkpoint()
+        self.CHECKPOINT = self._empty_state()
 
     def deactivate(self) -> None:
         """
@@ -94,7 +1365,11 @@ class ChatOpsAnything(BotPlugin):
             None
         """
         try:
-            if 'TMP_CLEANUP' in self.config and self.config['TMP_CLEANUP']:
+            self._stop_delivery()
+            if self.config.get('WARM_RESTART', False):
+                # keep TEMP_PATH around so the next activation can reuse our downloads. It cleans it up if it can't
+                self._save_checkpoint()
+            elif 'TMP_CLEANUP' in self.config and self.config['TMP_CLEANUP']:
                 self._cleanup_tempdir(self.config['TEMP_PATH'])
             # destroy our dynamic plugin cleanly
             self.destroy_dynamic_plugin(self.config['PLUGIN_NAME'])
@@ -103,6 +1378,20 @@ class ChatOpsAnything(BotPlugin):
             self.log.exception(str(error))
         super().deactivate()
 
+    def _stop_delivery(self) -> None:
+        """
+        Sends anything still waiting in OUTBOUND_QUEUE, stops its worker and shuts down TRACER. Commands still running
+        keep their own reference to the stopped queue, which then sends on their thread
+        Returns:
+            None
+        """
+        if self.OUTBOUND_QUEUE is not None:
+            self.OUTBOUND_QUEUE.stop(timeout=float(self.config['TIMEOUT']))
+            self.OUTBOUND_QUEUE = None
+        if self.TRACER is not None:
+            self.TRACER.shutdown()
+            self.TRACER = None
+
     def configure(self, configuration: Dict) -> None:
         """
         Configures the plugin
@@ -151,9 +1440,38 @@ class ChatOpsAnything(BotPlugin):
         if 'PLUGIN_NAME' not in configuration:
             configuration['PLUGIN_NAME'] = os.getenv("COPS_PLUGIN_NAME", "Chatops Anything")
 
+        # WARM_RESTART checkpoints our downloads and help text to STATE_PATH on deactivate so the next activate can
+        # reuse whatever is still valid. STATE_PATH defaults to a file in errbot's data dir
+        if 'WARM_RESTART' not in configuration:
+            configuration['WARM_RESTART'] = os.getenv("COPS_WARM_RESTART", "true").lower() in ['true', '1', 'yes']
+        if 'STATE_PATH' not in configuration or not configuration['STATE_PATH']:
+            state_file = f"{re.sub(r'[^a-z0-9]+', '-', configuration['PLUGIN_NAME'].lower())}-state.json"
+            configuration['STATE_PATH'] = os.getenv("COPS_STATE_PATH",
+                                                    os.path.join(self.bot_config.BOT_DATA_DIR, state_file))
+
         if 'MAX_DOWNLOAD_SIZE' not in configuration:
             configuration['MAX_DOWNLOAD_SIZE'] = os.getenv("COPS_MAX_DL", 3e7)  # approx 30mb
 
+        # how many results !cops search shows per page
+        if 'SEARCH_PAGE_SIZE' not in configuration:
+            configuration['SEARCH_PAGE_SIZE'] = os.getenv("COPS_SEARCH_PAGE_SIZE", 10)
+
+        # pacing for messages we send to chat. SEND_RATE is messages per second, SEND_BURST is how many we can send
+        # back to back and SEND_RETRIES is how many times we retry a send that was rate limited by the backend
+        if 'SEND_RATE' not in configuration:
+            configuration['SEND_RATE'] = os.getenv("COPS_SEND_RATE", 1)
+        if 'SEND_BURST' not in configuration:
+            configuration['SEND_BURST'] = os.getenv("COPS_SEND_BURST", 5)
+        if 'SEND_RETRIES' not in configuration:
+            configuration['SEND_RETRIES'] = os.getenv("COPS_SEND_RETRIES", 3)
+
+        # TRACE_PATH is a file to write a json line per traced span to. Leave it blank to turn off tracing.
+        # TRACE_SAMPLE_RATE is the fraction of command invocations to trace, from 0 to 1
+        if 'TRACE_PATH' not in configuration:
+            configuration['TRACE_PATH'] = os.getenv("COPS_TRACE_PATH", None)
+        if 'TRACE_SAMPLE_RATE' not in configuration:
+            configuration['TRACE_SAMPLE_RATE'] = os.getenv("COPS_TRACE_SAMPLE_RATE", 1.0)
+
         super().configure(configuration)
 
     def get_configuration_template(self) -> Dict:
@@ -169,7 +1487,15 @@ class ChatOpsAnything(BotPlugin):
                 "EXCLUSIONS": ["bin1", "bin2"],  # any executables to exclude, just the names of them
                 "PLUGIN_NAME": "Chatops Anything",  # optional, just a name
                 "TIMEOUT": 30,  # seconds to wait for a command to execute
-                "MAX_DOWNLOAD_SIZE": 3e7  # file size in bytes, default is approx 30mb
+                "MAX_DOWNLOAD_SIZE": 3e7,  # file size in bytes, default is approx 30mb
+                "SEARCH_PAGE_SIZE": 10,  # results per page for !cops search
+                "SEND_RATE": 1,  # messages per second we send to chat
+                "SEND_BURST": 5,  # messages we can send back to back before SEND_RATE applies
+                "SEND_RETRIES": 3,  # times to retry a send that was rate limited
+                "TRACE_PATH": "",  # optional, file to write traces of each command to as json lines. blank is off
+                "TRACE_SAMPLE_RATE": 1.0,  # fraction of commands to trace, from 0 to 1
+                "WARM_RESTART": True,  # reuse downloads and help text from the last activation if they're still valid
+                "STATE_PATH": ""  # optional, file to keep warm restart state in. Defaults to errbot's data dir
                 }
 
     def check_configuration(self, configuration: Dict) -> None:
@@ -227,6 +1553,21 @@ class ChatOpsAnything(BotPlugin):
             self.log.info(f"BIN_PATH and CONFIG_PATH configured to same directory. This can cause issues. "
                           f"Suggest moving config to its own directory")
 
+        # a SEND_RATE of 0 or a SEND_BURST under 1 would leave the outbound queue never able to send anything
+        numbers = [('SEND_RATE', float, lambda value: value > 0, "a number greater than 0"),
+                   ('SEND_BURST', float, lambda value: value >= 1, "a number of at least 1"),
+                   ('SEND_RETRIES', int, lambda value: value >= 0, "an int of 0 or more"),
+                   ('TRACE_SAMPLE_RATE', float, lambda value: 0 <= value <= 1, "a number from 0 to 1")]
+        for key, number_type, is_valid, description in numbers:
+            if configuration.get(key, None) is None:
+                continue
+            try:
+                value = number_type(configuration[key])
+            except (TypeError, ValueError):
+                raise ValidationException(f"Chatops Anything: Invalid configuration, {key} must be {description}")
+            if isinstance(configuration[key], bool) or not math.isfinite(value) or not is_valid(value):
+                raise ValidationException(f"Chatops Anything: Invalid configuration, {key} must be {description}")
+
         # we don't really need to validate EXCLUSIONS. If they dont exist in BIN_PATH, we still will exclude them
         return
 
@@ -288,8 +1629,8 @@ class ChatOpsAnything(BotPlugin):
                         url = urlparse(loaded_config['url'].strip())
                         if url.scheme in ['http', 'https']:
                             try:
-                                loaded_config['bin_path'] = self._download_executable(loaded_config['url'],
-                                                                                      loaded_config['name'])
+                                loaded_config['bin_path'] = self._fetch_executable(loaded_config['url'],
+                                                                                   loaded_config['name'])
                             except ValidationException as exception:
                                 self.log.error(f"Error downloading executable at {loaded_config['url']}. {exception}")
                                 continue
@@ -319,6 +1660,310 @@ class ChatOpsAnything(BotPlugin):
 
         return config_dict
 
+    def _compile_command_spec(self, name: str, exec_config: Dict) -> CommandSpec:
+        """
+        Validates a single command config against COMMAND_CONFIG_SCHEMA and compiles it into a CommandSpec with all of
+        our defaults resolved
+        Args:
+            name (str): canonical name of the command
+            exec_config (Dict): config for the command, as built by activate
+
+        Returns:
+            CommandSpec - compiled command
+
+        Raises:
+            errbot.ValidationException when the config is invalid
+        """
+        for key, value in exec_config.items():
+            if key not in COMMAND_CONFIG_SCHEMA:
+                raise ValidationException(f"Chatops Anything: Invalid config for {name}. Unknown key {key}")
+            if not isinstance(value, COMMAND_CONFIG_SCHEMA[key]):
+                raise ValidationException(f"Chatops Anything: Invalid config for {name}. {key} is a "
+                                          f"{type(value).__name__}, expected one of "
+                                          f"{', '.join(t.__name__ for t in COMMAND_CONFIG_SCHEMA[key])}")
+
+        if 'bin_path' not in exec_config:
+            raise ValidationException(f"Chatops Anything: Invalid config for {name}. No bin_path")
+
+        # timeout might be a str if it came from an envvar, so make sure it turns into a positive number
+        timeout = exec_config.get('timeout', self.config['TIMEOUT'])
+        # True is an int too, and float() would make it a 1s timeout
+        if isinstance(timeout, bool):
+            raise ValidationException(f"Chatops Anything: Invalid config for {name}. timeout {timeout} is not a number")
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            raise ValidationException(f"Chatops Anything: Invalid config for {name}. timeout {timeout} is not a number")
+        if not math.isfinite(timeout) or timeout <= 0:
+            raise ValidationException(f"Chatops Anything: Invalid config for {name}. timeout must be a finite number "
+                                      f"greater than 0")
+
+        # the environment can only hold strings, so convert them all now rather than on every run
+        env_vars = None
+        if exec_config.get('env_vars'):
+            env_vars = dict()
+            for key, value in exec_config['env_vars'].items():
+                if not isinstance(value, ENV_VAR_VALUE_TYPES):
+                    raise ValidationException(f"Chatops Anything: Invalid config for {name}. env_vars {key} is a "
+                                              f"{type(value).__name__}, env vars must be a str or number")
+                env_vars[str(key)] = str(value)
+
+        # aliases get canonicalized the same way command names are in _load_exec_configs
+        aliases = list()
+        for alias in exec_config.get('aliases', list()):
+            if not isinstance(alias, str) or alias.strip() == "":
+                raise ValidationException(f"Chatops Anything: Invalid config for {name}. aliases must be a list of "
+                                          f"non-empty str")
+            alias = alias.lower().strip().replace(" ", "_")
+            if alias != name and alias not in aliases:
+                aliases.append(alias)
+
+        category = exec_config.get('category', DEFAULT_CATEGORY).strip().lower() or DEFAULT_CATEGORY
+
+        arguments = None
+        if 'args' in exec_config:
+            arguments = self._compile_argument_spec(name, exec_config['args'])
+
+        fan_out = None
+        # an empty dict means "all the defaults", so only an explicit false turns fan_out off
+        if exec_config.get('fan_out', False) is not False:
+            fan_out = self._compile_fan_out_spec(name, exec_config['fan_out'])
+
+        try:
+            filters = OutputPipeline.compile(exec_config.get('filters', list()))
+        except ValueError as error:
+            raise ValidationException(f"Chatops Anything: Invalid filters for {name}. {error}")
+
+        return CommandSpec(name=name,
+                           bin_path=Path(exec_config['bin_path']),
+                           help=exec_config.get('help', ""),
+                           timeout=timeout,
+                           env_vars=env_vars,
+                           aliases=tuple(aliases),
+                           category=category,
+                           arguments=arguments,
+                           fan_out=fan_out,
+                           filters=filters)
+
+    @staticmethod
+    def _compile_fan_out_spec(name: str, fan_out_config) -> FanOutSpec:
+        """
+        Validates the fan_out section of a command config and compiles it into a FanOutSpec
+        Args:
+            name (str): canonical name of the command, for error messages
+            fan_out_config (bool or Dict): True to use all the defaults, or a dict of FAN_OUT_DEFAULTS keys
+
+        Returns:
+            FanOutSpec - compiled fan_out config
+
+        Raises:
+            errbot.ValidationException when the config is invalid
+        """
+        settings = dict(FAN_OUT_DEFAULTS)
+        if not isinstance(fan_out_config, dict) and fan_out_config is not True:
+            raise ValidationException(f"Chatops Anything: Invalid fan_out for {name}. Must be true, false or a dict")
+        if isinstance(fan_out_config, dict):
+            for key, value in fan_out_config.items():
+                if key not in FAN_OUT_DEFAULTS:
+                    raise ValidationException(f"Chatops Anything: Invalid fan_out for {name}. Unknown key {key}")
+                if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                    raise ValidationException(f"Chatops Anything: Invalid fan_out for {name}. {key} must be an int "
+                                              f"of 0 or more")
+                settings[key] = value
+        if settings['width'] < 1:
+            raise ValidationException(f"Chatops Anything: Invalid fan_out for {name}. width must be at least 1")
+        return FanOutSpec(**settings)
+
+    @staticmethod
+    def _compile_argument_spec(name: str, args_config: Dict) -> ArgumentSpec:
+        """
+        Validates the args schema from a command config and compiles it into an ArgumentSpec
+        Args:
+            name (str): canonical name of the command, for error messages
+            args_config (Dict): the args section of the command config
+
+        Returns:
+            ArgumentSpec - compiled args schema
+
+        Raises:
+            errbot.ValidationException when the schema is invalid
+        """
+        def invalid(reason: str) -> ValidationException:
+            return ValidationException(f"Chatops Anything: Invalid args for {name}. {reason}")
+
+        def positive_int(value, field: str) -> Optional[int]:
+            if value is None:
+                return None
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise invalid(f"{field} must be a positive int")
+            return value
+
+        for key in args_config:
+            if key not in ARGS_CONFIG_KEYS:
+                raise invalid(f"Unknown key {key}")
+        if not isinstance(args_config.get('positional', list()), list):
+            raise invalid("positional must be a list")
+
+        positionals = list()
+        optional_seen = False
+        for index, positional_config in enumerate(args_config.get('positional', list())):
+            if not isinstance(positional_config, dict) or 'name' not in positional_config:
+                raise invalid(f"positional {index} must be a dict with a name")
+            for key in positional_config:
+                if key not in POSITIONAL_CONFIG_KEYS:
+                    raise invalid(f"Unknown key {key} in positional {positional_config['name']}")
+            arg_name = str(positional_config['name'])
+
+            pattern = None
+            if 'pattern' in positional_config:
+                try:
+                    pattern = re.compile(str(positional_config['pattern']))
+                except re.error as error:
+                    raise invalid(f"pattern for {arg_name} is not a valid regex. {error}")
+
+            choices = None
+            if 'choices' in positional_config:
+                if not isinstance(positional_config['choices'], list) or not positional_config['choices']:
+                    raise invalid(f"choices for {arg_name} must be a non-empty list")
+                choices = frozenset(str(choice) for choice in positional_config['choices'])
+
+            # a min or max without a type means the argument is a number
+            type_name = positional_config.get('type', None)
+            if type_name is None and ('min' in positional_config or 'max' in positional_config):
+                type_name = 'float'
+            if type_name is not None and type_name not in POSITIONAL_TYPES:
+                raise invalid(f"type for {arg_name} must be one of {', '.join(POSITIONAL_TYPES)}")
+            arg_type = None if type_name in (None, 'str') else POSITIONAL_TYPES[type_name]
+            bounds = dict()
+            for bound in ['min', 'max']:
+                value = positional_config.get(bound, None)
+                if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)
+                                          or not math.isfinite(value)):
+                    raise invalid(f"{bound} for {arg_name} must be a finite number")
+                bounds[bound] = value
+            if arg_type is None and (bounds['min'] is not None or bounds['max'] is not None):
+                raise invalid(f"{arg_name} has a min or max but is a str")
+
+            required = positional_config.get('required', True)
+            repeat = positional_config.get('repeat', False)
+            for flag, value in [('required', required), ('repeat', repeat)]:
+                # bool("false") is True, so don't guess at what a quoted value meant
+                if not isinstance(value, bool):
+                    raise invalid(f"{flag} for {arg_name} must be true or false")
+            if required and optional_seen:
+                raise invalid(f"{arg_name} is required but comes after an optional argument")
+            optional_seen = optional_seen or not required
+            if repeat and index != len(args_config['positional']) - 1:
+                raise invalid(f"only the last positional can repeat, {arg_name} is not last")
+
+            positionals.append(PositionalArgument(name=arg_name,
+                                                  pattern=pattern,
+                                                  choices=choices,
+                                                  number_type=arg_type,
+                                                  minimum=bounds['min'],
+                                                  maximum=bounds['max'],
+                                                  max_length=positive_int(positional_config.get('max_length', None),
+                                                                          f"max_length for {arg_name}"),
+                                                  required=required,
+                                                  repeat=repeat))
+
+        allow_extra = args_config.get('allow_extra', False)
+        if not isinstance(allow_extra, bool):
+            raise invalid("allow_extra must be true or false")
+        return ArgumentSpec(positionals=tuple(positionals),
+                            max_length=positive_int(args_config.get('max_length', None), "max_length"),
+                            allow_extra=allow_extra)
+
+    def _update_command_index(self, command_specs: Dict[str, CommandSpec]) -> None:
+        """
+        Brings COMMAND_INDEX in line with command_specs, only touching commands that were added, changed or removed
+        Args:
+            command_specs (Dict[str, CommandSpec]): every command and alias we have, keyed by name
+
+        Returns:
+            None
+        """
+        specs = {spec.name: spec for spec in command_specs.values()}
+        for name in self.COMMAND_INDEX.names():
+            if name not in specs:
+                self.log.debug(f"Removing {name} from the command index")
+                self.COMMAND_INDEX.remove(name)
+        for name, spec in specs.items():
+            indexed = self.COMMAND_INDEX.get(name)
+            if indexed is not None and (indexed.help, indexed.aliases, indexed.category) == \
+                    (spec.help, spec.aliases, spec.category):
+                continue
+            self.log.debug(f"Indexing {name}")
+            self.COMMAND_INDEX.add(spec)
+
+    def _fetch_executable(self, url: str, filename: str) -> str:
+        """
+        Gets the executable at url into our temp path, reusing the one from our checkpoint if it is still there and
+        unchanged, and the server says it hasn't changed either, rather than downloading it again
+        Args:
+            url (str): Url to download
+            filename (str): name to store the file as
+
+        Returns:
+            path (str): Path where we've stored the file
+        """
+        checkpointed = self.CHECKPOINT['downloads'].get(url, None)
+        filepath = None
+        if checkpointed is not None and checkpointed['name'] == filename and \
+                checkpointed['fingerprint'] == self._fingerprint(checkpointed['path']) and \
+                self._is_download_current(url, checkpointed.get('validators', dict())):
+            filepath = Path(os.path.join(self.TEMP_PATH, filename))
+            try:
+                if Path(checkpointed['path']) != filepath:
+                    # it's in the last activation's tempdir, move it into ours. Its help is cached by path, so move
+                    # that along with it or we'd probe it again
+                    move(checkpointed['path'], filepath)
+                    checkpointed_help = self.CHECKPOINT['help'].pop(checkpointed['path'], None)
+                    if checkpointed_help is not None:
+                        self.CHECKPOINT['help'][str(filepath)] = checkpointed_help
+                self.log.debug(f"Reusing {url} downloaded to {filepath} by the last activation")
+                filepath = str(filepath)
+            except OSError as error:
+                # a reused download is only an optimization, fetch it again rather than failing to activate
+                self.log.error(f"Unable to reuse {checkpointed['path']} for {url}, downloading it again. {error}")
+                filepath = None
+        if filepath is None:
+            # records the new download's validators in RESOLVED_STATE
+            filepath = self._download_executable(url, filename)
+        else:
+            self.RESOLVED_STATE['downloads'][url] = {'validators': checkpointed['validators']}
+        self.RESOLVED_STATE['downloads'].setdefault(url, dict()).update({'name': filename, 'path': filepath})
+        return filepath
+
+    def _is_download_current(self, url: str, validators: Dict) -> bool:
+        """
+        Asks the server whether the file at url has changed since we downloaded it, with a conditional GET using the
+        ETag and Last-Modified it sent us then
+        Args:
+            url (str): Url we downloaded
+            validators (Dict): etag and last_modified from when we downloaded it
+
+        Returns:
+            bool - True if the server says our copy is current. False if it changed, we can't tell or we can't ask
+        """
+        headers = dict()
+        if validators.get('etag', None):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified', None):
+            headers['If-Modified-Since'] = validators['last_modified']
+        if not headers:
+            # nothing to check with, so a "latest" url could have moved on. Download it again to be safe
+            return False
+        try:
+            with requests.get(url, headers=headers, allow_redirects=True, stream=True) as response:
+                current = response.status_code == 304
+        except requests.RequestException as error:
+            self.log.error(f"Unable to check if {url} changed, downloading it again. {error}")
+            return False
+        if not current:
+            self.log.info(f"{url} changed since the last activation, downloading it again")
+        return current
+
     def _download_executable(self, url: str, filename: str) -> str:
         """
         Downloads an executable over http or https and stores it in our temp path, sets it executable
@@ -340,6 +1985,10 @@ class ChatOpsAnything(BotPlugin):
                 for chunk in response.iter_content(chunk_size=1024):
                     if chunk:  # filter out keep-alive new chunks
                         file.write(chunk)
+            # lets the next warm restart ask the server if this changed rather than trusting our copy forever
+            validators = {'etag': response.headers.get('ETag', None),
+                          'last_modified': response.headers.get('Last-Modified', None)}
+            self.RESOLVED_STATE['downloads'].setdefault(url, dict())['validators'] = validators
         self.log.debug(f"Successful download to {filepath}, setting executable")
         st = os.stat(filepath)
         # this is like doing chmod +x
@@ -408,42 +2057,433 @@ class ChatOpsAnything(BotPlugin):
         Returns:
             Str - messages to send to the user
         """
+        # hold on to the queue and tracer we started with. A deactivate while we run replaces them, and a stopped
+        # queue still sends, just on our thread
+        queue = self.OUTBOUND_QUEUE
+        trace = self.TRACER.start_trace("run_command", user=str(msg.frm))
+        with trace:
+            return self._run_command(msg, args, queue, trace)
+
+    def _run_command(self, msg: ErrbotMessage, args: str, queue: OutboundQueue, trace: Span) -> str:
+        """
+        Does the work for run_command, recording a span for each step under trace
+        Args:
+            msg (ErrbotMessage): Errbot Message Object
+            args (str): Args from chatops
+            queue (OutboundQueue): queue to send our messages through
+            trace (Span): root span of this invocation's trace. A NoopSpan if we're not tracing it
+
+        Returns:
+            Str - messages to send to the user
+        """
         self.log.debug(f"Message coming in {msg}")
-        msg_without_args = msg.body.replace(args, '')
-        self.log.debug(f"Message stripped of args {msg_without_args}")
-        command_name = msg_without_args.replace(self._bot.prefix, '').lower().strip().replace(" ", "_")
-        self.log.debug(f"I think the command being run is {command_name}")
-        executable_config = self.EXECUTABLE_CONFIGS[command_name] if command_name in self.EXECUTABLE_CONFIGS else None
-        if executable_config is None:
+        with trace.child("routing") as span:
+            msg_without_args = msg.body.replace(args, '')
+            self.log.debug(f"Message stripped of args {msg_without_args}")
+            command_name = msg_without_args.replace(self._bot.prefix, '').lower().strip().replace(" ", "_")
+            self.log.debug(f"I think the command being run is {command_name}")
+            span.set_attribute('command', command_name)
+        trace.set_attribute('command', command_name)
+
+        with trace.child("admission") as span:
+            command_spec = self.EXECUTABLE_CONFIGS.get(command_name, None)
+            # anything after an unquoted | is output filters for just this run
+            args, *invocation_filters = OutputPipeline.split_pipes(args)
+            filters_error = None
+            filters = OutputPipeline()
+            if command_spec is not None:
+                filters = command_spec.filters
+                if invocation_filters:
+                    try:
+                        filters = filters + OutputPipeline.compile(invocation_filters)
+                    except ValueError as error:
+                        filters_error = str(error)
+            # check the arguments against the command's schema before we spend a process on them
+            args_error = None
+            if command_spec is not None and command_spec.arguments is not None:
+                args_error = command_spec.arguments.check(args)
+            span.set_attribute('admitted', command_spec is not None and args_error is None and filters_error is None)
+            span.set_attribute('filters', filters.description)
+        if command_spec is None:
             self.log.error(f"{command_name} not in self.EXECUTABLE_CONFIGS")
             return f"Unable to run your command {command_name} because I am not able to find it in the plugins config."
+        if filters_error is not None:
+            self.log.info(f"Rejected filters '{' | '.join(invocation_filters)}' for {command_name}. {filters_error}")
+            return f"Invalid output filter: {filters_error}"
+        if args_error is not None:
+            self.log.info(f"Rejected arguments '{args}' for {command_name}. {args_error}")
+            return f"Invalid arguments: {args_error}\n" \
+                   f"Usage: {self._bot.prefix}{command_name} {command_spec.arguments.usage}"
+
+        self.log.debug(f"Got config {command_spec}")
+        if command_spec.fan_out is not None:
+            return self._run_fan_out(msg, args, command_spec, filters, queue, trace)
 
-        self.log.debug(f"Got config {executable_config}")
         try:
-            # delegator is awesome and does a bunch of shell escaping for us. Ty Kenneth
-            command = delegator.run(f"{executable_config['bin_path']} {args}",
-                                    block=False,
-                                    timeout=executable_config['timeout'] if 'timeout' in executable_config else
-                                    self.config['TIMEOUT'],
-                                    env=executable_config['env_vars'] if 'env_vars' in executable_config else None)
+            command = self._spawn_command(command_spec, args, trace)
         except FileNotFoundError:
-            self.log.error(f"Executable not found at {executable_config['bin_path']}")
-            return f"Error: Executable not found at {executable_config['bin_path']}"
+            self.log.error(f"Executable not found at {command_spec.bin_path}")
+            return f"Error: Executable not found at {command_spec.bin_path}"
         except OSError as error:
-            self.log.error(f"Executable at {executable_config['bin_path']} threw an os error {error}")
+            self.log.error(f"Executable at {command_spec.bin_path} threw an os error {error}")
             return f"Error: Error received when running your command.\n{error}"
 
-        self.log.info(f"{executable_config['bin_path']} running with PID {command.pid}")
+        self.log.info(f"{command_spec.bin_path} running with PID {command.pid}")
+        trace.set_attribute('pid', command.pid)
 
         # argh, gotta use self.send rather than yielding here because of how we're calling this from a lambda to make
         # it a bot cmd. This breaks people's "divert to thread" or "divert to dm" rules. Sorry.
-        self.send(msg.to, text=f"Started your command with PID {command.pid}", in_reply_to=msg)
-        command.block()
+        # The sends go through the outbound queue, which will usually merge the output and RC into one message
+        queue.enqueue(msg.to, f"Started your command with PID {command.pid}", in_reply_to=msg, span=trace)
+
+        output, output_bytes = self._wait_for_command(command, command_spec, filters, trace)
+        trace.set_attribute('rc', command.return_code)
+        trace.set_attribute('bytes', output_bytes)
+
+        queue.enqueue(msg.to, output, in_reply_to=msg, span=trace)
+        queue.enqueue(msg.to, f"Command {self._exit_status(command)}", in_reply_to=msg, span=trace)
+        return
 
-        self.send(msg.to, text=command.out, in_reply_to=msg)
-        self.send(msg.to, text=f"Command RC: {command.return_code}", in_reply_to=msg)
+    def _run_fan_out(self, msg: ErrbotMessage, args: str, command_spec: CommandSpec, filters: OutputPipeline,
+                     queue: OutboundQueue, trace: Span) -> str:
+        """
+        Runs a fan_out command once per target, up to fan_out.width at a time. A line for each target is sent as it
+        finishes, with the first lines of output for any that fail, followed by a summary
+        Args:
+            msg (ErrbotMessage): Errbot Message Object
+            args (str): Args from chatops, already checked against the command's args schema
+            command_spec (CommandSpec): the command to run
+            filters (OutputPipeline): filters to run each target's output through
+            queue (OutboundQueue): queue to send our messages through
+            trace (Span): root span of this invocation's trace
+
+        Returns:
+            Str - messages to send to the user
+        """
+        fan_out = command_spec.fan_out
+        try:
+            values = shlex.split(args)
+        except ValueError as error:
+            return f"Invalid arguments: unable to parse arguments, {error}"
+        common, targets = values[:fan_out.common_args], values[fan_out.common_args:]
+        if not targets:
+            return f"No targets given. {command_spec.name} runs once for each argument after the first " \
+                   f"{fan_out.common_args}"
+
+        width = min(fan_out.width, len(targets))
+        trace.set_attribute('targets', len(targets))
+        queue.enqueue(msg.to, f"Running {command_spec.name} against {len(targets)} targets, "
+                              f"{width} at a time", in_reply_to=msg, span=trace)
+
+        def run_target(target: str) -> Tuple[str, Optional[int], str, float, str]:
+            target_span = trace.child("target", target=target)
+            start = time.monotonic()
+            with target_span:
+                try:
+                    command = self._spawn_command(command_spec,
+                                                  " ".join(shlex.quote(value) for value in common + [target]),
+                                                  target_span)
+                except OSError as error:
+                    # FileNotFoundError is an OSError too
+                    self.log.error(f"Executable at {command_spec.bin_path} threw an os error {error} for {target}")
+                    return target, None, "failed to start", time.monotonic() - start, str(error)
+                try:
+                    output, _ = self._wait_for_command(command, command_spec, filters, target_span)
+                except Exception as error:
+                    # a read or filter blew up. Report it as this target failing rather than losing every other target
+                    self.log.exception(f"{command_spec.bin_path} failed for {target}. {error}")
+                    target_span.set_attribute('error', repr(error))
+                    return target, None, "error", time.monotonic() - start, str(error)
+                target_span.set_attribute('rc', command.return_code)
+            return target, command.return_code, self._exit_status(command), time.monotonic() - start, output
+
+        failed = 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=width) as executor:
+            futures = [executor.submit(run_target, target) for target in targets]
+            for future in as_completed(futures):
+                target, return_code, exit_status, duration, output = future.result()
+                if return_code == 0:
+                    line = f"[ok] {target} RC: 0 ({duration:.1f}s)"
+                else:
+                    failed += 1
+                    line = f"[FAIL] {target} {exit_status} ({duration:.1f}s)"
+                    for output_line in output.splitlines()[:fan_out.failure_lines]:
+                        line += f"\n    {output_line}"
+                # the outbound queue merges these, so a burst of finished targets goes out as one message
+                queue.enqueue(msg.to, line, in_reply_to=msg, span=trace)
+
+        trace.set_attribute('failed', failed)
+        queue.enqueue(msg.to, f"Fan-out finished in {time.monotonic() - start:.1f}s: "
+                              f"{len(targets) - failed} ok, {failed} failed", in_reply_to=msg, span=trace)
         return
 
+    def _spawn_command(self, command_spec: CommandSpec, args: str, trace: Span) -> delegator.Command:
+        """
+        Starts command_spec's executable with args, without waiting for it
+        Args:
+            command_spec (CommandSpec): the command to run
+            args (str): arguments to pass to it
+            trace (Span): span to record the spawn under
+
+        Returns:
+            delegator.Command - the running command
+
+        Raises:
+            FileNotFoundError when the executable doesn't exist, OSError when it can't be run
+        """
+        with trace.child("spawn", bin_path=str(command_spec.bin_path)) as span:
+            # delegator is awesome and does a bunch of shell escaping for us. Ty Kenneth
+            command = delegator.run(f"{command_spec.bin_path} {args}",
+                                    block=False,
+                                    timeout=command_spec.timeout,
+                                    env=command_spec.env_vars)
+            span.set_attribute('pid', command.pid)
+        return command
+
+    def _wait_for_command(self, command: delegator.Command, command_spec: CommandSpec, filters: OutputPipeline,
+                          trace: Span) -> Tuple[str, int]:
+        """
+        Streams a running command's output through filters until it exits. If the command is still running its timeout
+        after we start waiting, it is killed with SIGKILL and its exit is then reported by signal rather than RC
+        Args:
+            command (delegator.Command): the running command
+            command_spec (CommandSpec): the command's spec
+            filters (OutputPipeline): filters to run the output through
+            trace (Span): span to record first_output and exit spans under
+
+        Returns:
+            Tuple[str, int] - the command's filtered output and the size of its unfiltered output in bytes
+        """
+        # ends when the first chunk of output is read
+        first_output_span = trace.child("first_output")
+        exit_span = trace.child("exit")
+        counts = {'chunks': 0, 'bytes': 0, 'timed_out': False}
+
+        def read_lines() -> Iterator[str]:
+            # take whatever output is waiting in one go and split it into lines ourselves. Iterating the pexpect spawn
+            # runs an expect() per line, which is many times slower on chatty commands
+            partial = ""
+            # timeout is for the whole run, so a command that keeps writing output still gets stopped
+            deadline = time.monotonic() + command_spec.timeout
+            while True:
+                if time.monotonic() > deadline:
+                    # stop reading rather than raising so filters still get to hand over what they have
+                    self.log.error(f"{command_spec.bin_path} with PID {command.pid} timed out after "
+                                   f"{command_spec.timeout}s")
+                    command.subprocess.kill(signal.SIGKILL)
+                    counts['timed_out'] = True
+                    break
+                try:
+                    chunk = command.subprocess.read_nonblocking(OUTPUT_READ_SIZE, timeout=None)
+                except PexpectEOF:
+                    break
+                if not chunk:
+                    time.sleep(OUTPUT_POLL_INTERVAL)
+                    continue
+                chunk_bytes = len(chunk.encode('utf-8'))
+                if counts['chunks'] == 0:
+                    first_output_span.set_attribute('bytes', chunk_bytes)
+                    first_output_span.end()
+                counts['chunks'] += 1
+                counts['bytes'] += chunk_bytes
+                *lines, partial = (partial + chunk).split("\n")
+                for line in lines:
+                    yield line + "\n"
+            if partial:
+                yield partial
+
+        try:
+            output = list(filters.apply(read_lines()))
+        except BaseException:
+            # a filter or the read blew up, don't leave the command running or unreaped behind us
+            command.subprocess.kill(signal.SIGKILL)
+            raise
+        finally:
+            command.block()
+            if counts['chunks'] == 0:
+                first_output_span.set_attribute('bytes', 0)
+                first_output_span.end()
+        if counts['timed_out']:
+            output.append(f"\nCommand timed out after {command_spec.timeout}s")
+        output = "".join(output)
+        exit_span.set_attribute('rc', command.return_code)
+        exit_span.set_attribute('signal', command.subprocess.signalstatus)
+        exit_span.set_attribute('bytes', counts['bytes'])
+        exit_span.set_attribute('filtered_bytes', len(output.encode('utf-8')))
+        exit_span.set_attribute('timed_out', counts['timed_out'])
+        exit_span.end()
+        return output, counts['bytes']
+
+    @staticmethod
+    def _exit_status(command: delegator.Command) -> str:
+        """
+        Describes how a finished command exited. A command killed by a signal, like one that timed out, has no RC
+        Args:
+            command (delegator.Command): a command that has been blocked on
+
+        Returns:
+            str - "RC: <rc>", or "killed by signal <number> (<name>)"
+        """
+        signal_number = command.subprocess.signalstatus
+        if command.return_code is None and signal_number is not None:
+            return f"killed by signal {signal_number} ({signal.Signals(signal_number).name})"
+        return f"RC: {command.return_code}"
+
+    @arg_botcmd('terms', type=str, nargs='+', help="terms to search for")
+    @arg_botcmd('--page', dest='page', type=int, default=1, help="page of results to show")
+    def cops_search(self, msg: ErrbotMessage, terms: List[str], page: int) -> str:
+        """
+        Searches our commands by name, alias, category and help text
+        """
+        query = " ".join(terms)
+        results = self.COMMAND_INDEX.search(query)
+        if not results:
+            return f"No commands found matching '{query}'"
+
+        page_size = max(int(self.config['SEARCH_PAGE_SIZE']), 1)
+        pages = math.ceil(len(results) / page_size)
+        if page < 1 or page > pages:
+            return f"Page {page} does not exist. There are {pages} pages of results for '{query}'"
+        page_results = results[(page - 1) * page_size:page * page_size]
+
+        # group this page by category, keeping categories in the order of their best match
+        grouped = dict()  # typing: Dict[str, List[CommandSpec]]
+        for spec, _ in page_results:
+            grouped.setdefault(spec.category, list()).append(spec)
+
+        lines = [f"Found {len(results)} commands matching '{query}' (page {page} of {pages})"]
+        for category, specs in grouped.items():
+            lines.append(f"**{category}**")
+            for spec in specs:
+                summary = spec.help.strip().splitlines()[0] if spec.help and spec.help.strip() else ""
+                aliases = f" (aliases: {', '.join(spec.aliases)})" if spec.aliases else ""
+                lines.append(f"- {spec.name}{aliases}: {summary}" if summary else f"- {spec.name}{aliases}")
+        if page < pages:
+            lines.append(f"Use --page {page + 1} to see more")
+        return "\n".join(lines)
+
+    @botcmd
+    def cops_queue(self, msg: ErrbotMessage, args: str) -> str:
+        """
+        Shows metrics for the outbound message queue
+        """
+        if self.OUTBOUND_QUEUE is None:
+            return "Outbound queue is not running"
+        metrics = self.OUTBOUND_QUEUE.metrics()
+        return "\n".join(f"{key}: {value}" for key, value in sorted(metrics.items()))
+
+    def _probe_help(self, executable: Path) -> str:
+        """
+        Gets help text for executable by running it with --help, unless our checkpoint has help for it and the
+        executable hasn't changed since
+        Args:
+            executable (Path): pathlib.Path object pointing to an executable file
+
+        Returns:
+            str: help text
+        """
+        key = str(executable)
+        fingerprint = self._fingerprint(executable)
+        checkpointed = self.CHECKPOINT['help'].get(key, None)
+        if fingerprint is not None and checkpointed is not None and checkpointed['fingerprint'] == fingerprint:
+            self.log.debug(f"Reusing help for {executable} from the last activation")
+            help_text = checkpointed['help']
+        else:
+            help_text = self._get_help(executable)
+        if fingerprint is not None:
+            self.RESOLVED_STATE['help'][key] = {'help': help_text, 'fingerprint': fingerprint}
+        return help_text
+
+    @staticmethod
+    def _empty_state() -> Dict:
+        """
+        Returns:
+            Dict - warm restart state with nothing in it
+        """
+        return {'version': STATE_VERSION, 'temp_path': None, 'tmp_cleanup': False, 'help': dict(), 'downloads': dict()}
+
+    @staticmethod
+    def _fingerprint(path) -> Optional[List[int]]:
+        """
+        Gets a cheap fingerprint of a file to tell if it changed since we checkpointed it
+        Args:
+            path (str or Path): file to fingerprint
+
+        Returns:
+            List[int] - size and modified time in ns of the file, None if it doesn't exist
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def _load_checkpoint(self) -> Dict:
+        """
+        Loads the warm restart state saved by the last deactivate from STATE_PATH
+        Returns:
+            Dict - the checkpoint, or an empty state if there isn't a usable one
+        """
+        state_path = Path(self.config['STATE_PATH'])
+        if not state_path.is_file():
+            self.log.debug(f"No warm restart state at {state_path}")
+            return self._empty_state()
+        try:
+            with open(state_path, 'r') as stream:
+                state = json.load(stream)
+        except (OSError, json.JSONDecodeError) as error:
+            self.log.error(f"Unable to read warm restart state at {state_path}, ignoring it. {error}")
+            return self._empty_state()
+        if not isinstance(state, dict) or state.get('version', None) != STATE_VERSION:
+            self.log.info(f"Warm restart state at {state_path} is from another version, ignoring it")
+            return self._empty_state()
+        checkpoint = self._empty_state()
+        checkpoint.update({key: state[key] for key in checkpoint if key in state})
+        self.log.info(f"Loaded warm restart state for {len(checkpoint['help'])} executables and "
+                      f"{len(checkpoint['downloads'])} downloads from {state_path}")
+        return checkpoint
+
+    def _remove_checkpoint(self) -> None:
+        """
+        Removes the warm restart state at STATE_PATH, if there is any
+        Returns:
+            None
+        """
+        try:
+            Path(self.config['STATE_PATH']).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            self.log.error(f"Unable to remove warm restart state at {self.config['STATE_PATH']}. {error}")
+
+    def _save_checkpoint(self) -> None:
+        """
+        Saves what this activation probed and downloaded to STATE_PATH for the next activate to reuse
+        Returns:
+            None
+        """
+        state = self._empty_state()
+        state['temp_path'] = str(self.TEMP_PATH)
+        state['tmp_cleanup'] = bool(self.config.get('TMP_CLEANUP', False))
+        state['help'] = self.RESOLVED_STATE['help']
+        for url, download in self.RESOLVED_STATE['downloads'].items():
+            fingerprint = self._fingerprint(download['path'])
+            if fingerprint is not None:
+                state['downloads'][url] = dict(download, fingerprint=fingerprint)
+
+        state_path = Path(self.config['STATE_PATH'])
+        # write to a temp file and rename it over the old state, so a crash can't leave half a state file behind
+        temp_state_path = state_path.with_name(f"{state_path.name}.{self.HASH}.tmp")
+        try:
+            with open(temp_state_path, 'w') as stream:
+                json.dump(state, stream)
+            os.replace(temp_state_path, state_path)
+        except OSError as error:
+            self.log.error(f"Unable to save warm restart state to {state_path}. {error}")
+            return
+        self.log.info(f"Saved warm restart state to {state_path}")
+
     def _get_help(self, executable: Path) -> str:
         """
         Returns the help text for executable, either set by config or by running the executable with --help
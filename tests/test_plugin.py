@@ -1,9 +1,13 @@
+import json
 import os
 from pathlib import Path
 import random
 import shutil
+import signal
 import stat
 import string
+import sys
+import threading
 from tempfile import gettempdir
 
 from errbot import ValidationException
@@ -31,6 +35,16 @@ def copytree(src, dst, symlinks=False, ignore=None):
                 shutil.copy2(s, d)
 
 
+def pop_command_response(testbot, until="Command RC"):
+    """
+    The outbound queue coalesces a command's messages depending on timing, so pop messages until we see the RC
+    """
+    messages = [testbot.pop_message()]
+    while until not in messages[-1]:
+        messages.append(testbot.pop_message())
+    return "\n".join(messages)
+
+
 def test_temp_dir(testbot):
     """
     Tests we can create a tempdir and destroy it properly if needed
@@ -178,6 +192,13 @@ def test_download_executable(testbot):
     with pytest.raises(HTTPError):
         plugin._download_executable("https://fakeurl.fakesite.com/fakefile2", "testfile")
 
+    # the download's validators are kept so a warm restart can ask if it changed
+    responses.add(responses.GET, "https://fakeurl.fakesite.com/fakefile3", status=200, body="file",
+                  headers={'ETag': '"v1"', 'Last-Modified': "Wed, 21 Oct 2026 07:28:00 GMT"})
+    plugin._download_executable("https://fakeurl.fakesite.com/fakefile3", "testfile")
+    assert plugin.RESOLVED_STATE['downloads']["https://fakeurl.fakesite.com/fakefile3"]['validators'] == {
+        'etag': '"v1"', 'last_modified': "Wed, 21 Oct 2026 07:28:00 GMT"}
+
 
 @responses.activate
 def test_load_exec_configs(testbot, mocker):
@@ -226,3 +247,577 @@ def test_load_exec_configs(testbot, mocker):
     assert loaded_configs['testlsjson']['env_vars']['key'] == "value"
     assert loaded_configs['testlsjson']['env_vars']['key2'] == "value2"
     assert loaded_configs['testlsjson']['timeout'] == 91
+
+
+def test_compile_command_spec(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    spec = plugin._compile_command_spec("testls", {'bin_path': "/bin/ls", 'help': "Help text",
+                                                   'env_vars': {'var_one': 1, 'var_two': "two"}})
+    assert spec.name == "testls"
+    assert spec.bin_path == Path("/bin/ls")
+    assert spec.help == "Help text"
+    # timeout wasn't set, so it should default to the plugin's TIMEOUT
+    assert spec.timeout == float(plugin.config['TIMEOUT'])
+    assert spec.env_vars == {'var_one': "1", 'var_two': "two"}
+
+    # specs are read only and slotted
+    with pytest.raises(AttributeError):
+        spec.timeout = 5
+    assert not hasattr(spec, '__dict__')
+
+    spec = plugin._compile_command_spec("testdl", {'bin_path': "/tmp/fake/executable", 'url': "https://fake",
+                                                   'timeout': "15"})
+    assert spec.timeout == 15
+    assert spec.env_vars is None
+
+    for bad_config in [{'bin_path': "/bin/ls", 'timout': 60},
+                       {'bin_path': "/bin/ls", 'timeout': "sixty"},
+                       {'bin_path': "/bin/ls", 'timeout': -1},
+                       {'bin_path': "/bin/ls", 'timeout': float("nan")},
+                       {'bin_path': "/bin/ls", 'timeout': "inf"},
+                       {'bin_path': "/bin/ls", 'timeout': True},
+                       {'bin_path': "/bin/ls", 'env_vars': ["not", "a", "dict"]},
+                       {'bin_path': "/bin/ls", 'env_vars': {'key': ["not", "a", "str"]}},
+                       {'help': "no bin_path"}]:
+        with pytest.raises(ValidationException):
+            plugin._compile_command_spec("bad", bad_config)
+
+
+def test_activate_compiles_specs(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    for name in ['testls', 'file', 'testoverwrite', 'testlsjson']:
+        assert name in plugin.EXECUTABLE_CONFIGS
+        assert plugin.EXECUTABLE_CONFIGS[name].name == name
+
+    assert plugin.EXECUTABLE_CONFIGS['testlsjson'].timeout == 91
+    assert plugin.EXECUTABLE_CONFIGS['testls'].env_vars == {'var_one': "1", 'var_two': "2"}
+
+    testbot.push_message('!testls /')
+    response = pop_command_response(testbot)
+    assert "Started your command with PID" in response
+    assert "bin" in response
+    assert "Command RC: 0" in response
+
+
+def test_command_index(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    check_disk = plugin._compile_command_spec("check_disk", {'bin_path': "/bin/df", 'category': "Storage",
+                                                             'aliases': ["Disk Check"],
+                                                             'help': "Checks free space on a host"})
+    restart = plugin._compile_command_spec("restart_service", {'bin_path': "/bin/true",
+                                                               'help': "Restarts a service on a host"})
+    assert check_disk.aliases == ("disk_check",)
+    assert check_disk.category == "storage"
+    assert restart.category == "uncategorized"
+
+    index = type(plugin.COMMAND_INDEX)()
+    index.add(check_disk)
+    index.add(restart)
+    assert len(index) == 2
+
+    # both match host, but check_disk also matches disk in its name so it ranks first
+    results = index.search("disk host")
+    assert [spec.name for spec, _ in results] == ["check_disk", "restart_service"]
+    assert results[0][1] > results[1][1]
+    assert [spec.name for spec, _ in index.search("disk_check")] == ["check_disk"]
+    assert [spec.name for spec, _ in index.search("storage")] == ["check_disk"]
+    assert index.search("nothing") == []
+
+    index.remove("check_disk")
+    assert "check_disk" not in index
+    assert [spec.name for spec, _ in index.search("disk host")] == ["restart_service"]
+    # removing the last command using a term drops the term entirely
+    assert "storage" not in index._postings
+
+
+def test_cops_search(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    assert "testls" in plugin.COMMAND_INDEX
+
+    testbot.push_message('!cops search testls')
+    response = testbot.pop_message()
+    assert "page 1 of 1" in response
+    assert "uncategorized" in response
+    assert "- testls: Help text" in response
+
+    testbot.push_message('!cops search testls --page 2')
+    assert "Page 2 does not exist" in testbot.pop_message()
+
+    testbot.push_message('!cops search nosuchcommandanywhere')
+    assert "No commands found" in testbot.pop_message()
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+    retry_after = 0.01
+
+
+def test_outbound_queue(testbot, monkeypatch):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    queue_class = type(plugin.OUTBOUND_QUEUE)
+    sent = list()
+    failures = [FakeRateLimitError("slow down")]
+
+    def fake_send(to, text, in_reply_to=None):
+        if failures:
+            raise failures.pop()
+        sent.append((to, text, in_reply_to))
+
+    queue = queue_class(fake_send, size_limit=20, rate=1000, burst=1000, max_retries=3, linger=0.2)
+    queue.start()
+    thread_msg = object()
+    queue.enqueue("room", "output", in_reply_to=thread_msg)
+    queue.enqueue("room", "Command RC: 0", in_reply_to=thread_msg)
+    queue.enqueue("other room", "x" * 45)
+    assert queue.flush(timeout=5)
+    queue.stop(timeout=5)
+
+    # output and rc were merged, the oversized message was split at the size limit
+    assert sent[0] == ("room", "output\nCommand RC: 0", thread_msg)
+    assert [text for _, text, _ in sent[1:]] == ["x" * 20, "x" * 20, "x" * 5]
+    metrics = queue.metrics()
+    assert metrics['coalesced'] == 1
+    assert metrics['retries'] == 1
+    assert metrics['sent'] == 2
+    assert metrics['chunks'] == 4
+    assert metrics['failed'] == 0
+    assert metrics['depth'] == 0
+
+    # once stopped, enqueue sends straight away on the caller's thread
+    queue.enqueue("room", "late")
+    assert sent[-1] == ("room", "late", None)
+
+    # a send that blows up is counted as failed and the worker keeps going
+    def broken_send(to, text, in_reply_to=None):
+        if text == "boom":
+            raise RuntimeError("backend went away")
+        sent.append((to, text, in_reply_to))
+
+    queue = queue_class(broken_send, size_limit=20, rate=1000, burst=1000, max_retries=3, linger=0)
+    queue.start()
+    queue.enqueue("room", "boom")
+    assert queue.flush(timeout=5)
+    queue.enqueue("room", "still here")
+    assert queue.flush(timeout=5)
+    queue.stop(timeout=5)
+    assert sent[-1] == ("room", "still here", None)
+    assert queue.metrics()['failed'] == 1
+
+    with pytest.raises(ValueError):
+        queue_class(fake_send, size_limit=20, rate=0, burst=1)
+    with pytest.raises(ValueError):
+        queue_class(fake_send, size_limit=20, rate=1, burst=0.5)
+    for bad_pacing in [{'SEND_RATE': 0}, {'SEND_RATE': "fast"}, {'SEND_BURST': 0}, {'SEND_RETRIES': -1},
+                       {'SEND_RETRIES': "1.5"}, {'TRACE_SAMPLE_RATE': "10%"}, {'TRACE_SAMPLE_RATE': 2}]:
+        with pytest.raises(ValidationException):
+            plugin.check_configuration(dict(plugin.config, **bad_pacing))
+
+    # a bad setting from the environment fails activation without leaving a worker thread running
+    plugin_manager = testbot.bot.plugin_manager
+    plugin_manager.deactivate_plugin('ChatOpsAnything')
+    monkeypatch.setenv("COPS_TRACE_SAMPLE_RATE", "10%")
+    with pytest.raises(Exception):
+        plugin_manager.activate_plugin('ChatOpsAnything')
+    assert plugin.OUTBOUND_QUEUE is None
+    assert not any(thread.name == "chatops-anything-outbound" for thread in threading.enumerate())
+    monkeypatch.delenv("COPS_TRACE_SAMPLE_RATE")
+    plugin_manager.activate_plugin('ChatOpsAnything')
+
+    assert queue_class.split_text("one\ntwo\nthree", 8) == ["one\ntwo", "three"]
+    assert queue_class.is_rate_limited(Exception("HTTP 429 Too Many Requests"))
+    assert not queue_class.is_rate_limited(Exception("channel not found"))
+
+    testbot.push_message('!cops queue')
+    assert "depth: 0" in testbot.pop_message()
+
+
+def test_tracing(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    tracer_module = sys.modules[type(plugin).__module__]
+    spans = list()
+
+    class ListExporter(tracer_module.SpanExporter):
+        def export(self, span):
+            spans.append(span)
+
+    class IncompleteExporter(tracer_module.SpanExporter):
+        pass
+
+    # an exporter without export fails when it's made, not on every span
+    with pytest.raises(TypeError):
+        IncompleteExporter()
+
+    # with no exporters, nothing is traced
+    assert not plugin.TRACER.start_trace("nothing").sampled
+
+    exporter = ListExporter()
+    plugin.TRACER.add_exporter(exporter)
+    try:
+        testbot.push_message('!testls /')
+        pop_command_response(testbot)
+        assert plugin.OUTBOUND_QUEUE.flush(timeout=5)
+    finally:
+        plugin.TRACER.remove_exporter(exporter)
+
+    by_name = dict()
+    for span in spans:
+        by_name.setdefault(span.name, list()).append(span)
+    for name in ['run_command', 'routing', 'admission', 'spawn', 'first_output', 'exit', 'send']:
+        assert name in by_name
+    root = by_name['run_command'][0]
+    assert root.parent_id is None
+    assert root.attributes['command'] == "testls"
+    assert root.attributes['rc'] == 0
+    assert root.attributes['bytes'] > 0
+    assert by_name['exit'][0].attributes['rc'] == 0
+    assert by_name['spawn'][0].attributes['pid'] == root.attributes['pid']
+    assert len(by_name['send']) == 3
+    for span in spans:
+        assert span.trace_id == root.trace_id
+        assert span.end_time >= span.start_time
+        if span is not root:
+            assert span.parent_id == root.span_id
+
+    # sample rate of 0 means nothing gets traced even with an exporter
+    tracer = tracer_module.Tracer(sample_rate=0)
+    tracer.add_exporter(ListExporter())
+    assert not tracer.start_trace("nothing").sampled
+
+
+def test_json_lines_span_exporter(testbot, tmp_path):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    tracer_module = sys.modules[type(plugin).__module__]
+    trace_path = tmp_path / "traces.jsonl"
+    tracer = tracer_module.Tracer(sample_rate=1)
+    tracer.add_exporter(tracer_module.JsonLinesSpanExporter(trace_path))
+    with tracer.start_trace("run_command", command="test") as root:
+        with root.child("spawn", pid=1):
+            pass
+    tracer.shutdown()
+
+    with open(trace_path, 'r') as file:
+        lines = [json.loads(line) for line in file]
+    assert [line['name'] for line in lines] == ["spawn", "run_command"]
+    assert lines[0]['parent_id'] == lines[1]['span_id']
+    assert lines[0]['attributes']['pid'] == 1
+    assert lines[1]['attributes']['command'] == "test"
+
+
+def test_run_command_timeout(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    testls = plugin.EXECUTABLE_CONFIGS['testls']
+    plugin.EXECUTABLE_CONFIGS['testls'] = plugin._compile_command_spec("testls", {'bin_path': "/bin/sleep",
+                                                                                  'timeout': 1})
+    try:
+        testbot.push_message('!testls 10')
+        response = pop_command_response(testbot, until="Command killed")
+        plugin.EXECUTABLE_CONFIGS['testls'] = plugin._compile_command_spec("testls", {'bin_path': "/bin/sleep",
+                                                                                      'timeout': 1, 'fan_out': True})
+        testbot.push_message('!testls 0 10')
+        fan_out_response = pop_command_response(testbot, until="Fan-out finished")
+    finally:
+        plugin.EXECUTABLE_CONFIGS['testls'] = testls
+    assert "Command timed out after 1.0s" in response
+    assert "Command killed by signal 9 (SIGKILL)" in response
+    assert "RC: None" not in response
+    assert "[ok] 0 RC: 0" in fan_out_response
+    assert "[FAIL] 10 killed by signal 9 (SIGKILL)" in fan_out_response
+
+    # the timeout covers the whole run, so a command that keeps writing output is still stopped
+    plugin_module = sys.modules[type(plugin).__module__]
+    chatty_spec = plugin._compile_command_spec("chatty", {'bin_path': "/bin/sh", 'timeout': 1})
+    command = plugin._spawn_command(chatty_spec, "-c 'while true; do echo still going; sleep 0.2; done'",
+                                    plugin_module.NOOP_SPAN)
+    output, _ = plugin._wait_for_command(command, chatty_spec, plugin_module.OutputPipeline.compile([]),
+                                         plugin_module.NOOP_SPAN)
+    assert output.startswith("still going\n")
+    assert output.endswith("Command timed out after 1.0s")
+    assert plugin._exit_status(command) == "killed by signal 9 (SIGKILL)"
+
+
+def test_argument_spec(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    spec = plugin._compile_command_spec("restart", {
+        'bin_path': "/bin/true",
+        'args': {'max_length': 40,
+                 'positional': [{'name': "host", 'pattern': "[a-z0-9.-]+", 'max_length': 20},
+                                {'name': "action", 'choices': ["start", "stop"]},
+                                {'name': "count", 'type': "int", 'min': 1, 'max': 5, 'required': False}]}})
+    arguments = spec.arguments
+    assert arguments.usage == "<host> <start|stop> [count]"
+    assert arguments.check("web1 start") is None
+    assert arguments.check("web1 stop 5") is None
+    assert arguments.check("") == "missing host"
+    assert "does not match" in arguments.check("WEB1 start")
+    assert "must be one of start, stop" in arguments.check("web1 restart")
+    assert "at most 5" in arguments.check("web1 start 6")
+    assert "must be a number" in arguments.check("web1 start lots")
+    assert "too many arguments" in arguments.check("web1 start 1 extra")
+    assert "at most 40 characters" in arguments.check("web1 start " + "1" * 40)
+    assert "unable to parse" in arguments.check("web1 'start")
+
+    repeating = plugin._compile_argument_spec("check", {'positional': [{'name': "host", 'pattern': "host[0-9]+",
+                                                                        'repeat': True}]})
+    assert repeating.usage == "<host>..."
+    assert repeating.check("host1 host2 host3") is None
+    assert "host4x" in repeating.check("host1 host4x")
+
+    ratio = plugin._compile_argument_spec("scale", {'positional': [{'name': "ratio", 'type': "float", 'min': 0.5,
+                                                                    'max': 2}]})
+    assert ratio.check("1.5") is None
+    for not_finite in ["nan", "inf", "-inf"]:
+        assert "must be a finite number" in ratio.check(not_finite)
+
+    for bad_args in [{'positionl': []},
+                     {'positional': [{'pattern': "no name"}]},
+                     {'positional': [{'name': "a", 'pattern': "("}]},
+                     {'positional': [{'name': "a", 'type': "list"}]},
+                     {'positional': [{'name': "a", 'type': "str", 'min': 1}]},
+                     {'positional': [{'name': "a", 'required': False}, {'name': "b"}]},
+                     {'positional': [{'name': "a", 'repeat': True}, {'name': "b"}]},
+                     {'positional': [{'name': "a", 'required': "false"}]},
+                     {'positional': [{'name': "a", 'repeat': 1}]},
+                     {'positional': [], 'allow_extra': "false"},
+                     {'positional': [{'name': "a", 'type': "float", 'max': float("nan")}]},
+                     {'max_length': 0}]:
+        with pytest.raises(ValidationException):
+            plugin._compile_argument_spec("bad", bad_args)
+
+
+def test_run_command_rejects_bad_args(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    testls = plugin.EXECUTABLE_CONFIGS['testls']
+    plugin.EXECUTABLE_CONFIGS['testls'] = plugin._compile_command_spec("testls", {
+        'bin_path': "/bin/ls", 'args': {'positional': [{'name': "path", 'choices': ["/"]}]}})
+    try:
+        testbot.push_message('!testls /nope')
+        response = testbot.pop_message()
+        # rejected before we spawn, so there's no PID message
+        assert "Invalid arguments: path must be one of /" in response
+        assert "Usage: !testls </>" in response
+        testbot.push_message('!testls /')
+        assert "Command RC: 0" in pop_command_response(testbot)
+    finally:
+        plugin.EXECUTABLE_CONFIGS['testls'] = testls
+
+
+def test_fan_out(testbot, mocker):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    for defaults in [True, {}]:
+        spec = plugin._compile_command_spec("testls", {'bin_path': "/bin/ls", 'fan_out': defaults})
+        assert (spec.fan_out.width, spec.fan_out.common_args, spec.fan_out.failure_lines) == (10, 0, 3)
+    spec = plugin._compile_command_spec("testls", {'bin_path': "/bin/ls", 'fan_out': False})
+    assert spec.fan_out is None
+    for bad_fan_out in [None, "yes", 1, {'width': 0}, {'widht': 2}, {'common_args': -1}, {'failure_lines': "3"}]:
+        with pytest.raises(ValidationException):
+            plugin._compile_command_spec("bad", {'bin_path': "/bin/ls", 'fan_out': bad_fan_out})
+
+    testls = plugin.EXECUTABLE_CONFIGS['testls']
+    plugin.EXECUTABLE_CONFIGS['testls'] = plugin._compile_command_spec("testls", {
+        'bin_path': "/bin/ls", 'fan_out': {'width': 2, 'common_args': 1, 'failure_lines': 1}})
+    try:
+        testbot.push_message('!testls -d / /nonexistent-target /tmp')
+        response = pop_command_response(testbot, until="Fan-out finished")
+
+        testbot.push_message('!testls -d')
+        assert "No targets given" in testbot.pop_message()
+    finally:
+        plugin.EXECUTABLE_CONFIGS['testls'] = testls
+
+    assert "Running testls against 3 targets, 2 at a time" in response
+    assert "[ok] / RC: 0" in response
+    assert "[ok] /tmp RC: 0" in response
+    assert "[FAIL] /nonexistent-target RC: 2" in response
+    assert "2 ok, 1 failed" in response
+
+    # a target whose output handling raises fails on its own, the rest still get reported
+    wait_for_command = plugin._wait_for_command
+
+    def broken_for_tmp(command, *args):
+        if command.cmd.endswith("/tmp"):
+            raise RuntimeError("filter blew up")
+        return wait_for_command(command, *args)
+
+    mocker.patch.object(plugin, "_wait_for_command", side_effect=broken_for_tmp)
+    plugin.EXECUTABLE_CONFIGS['testls'] = plugin._compile_command_spec("testls", {'bin_path': "/bin/ls",
+                                                                                  'fan_out': True})
+    try:
+        testbot.push_message('!testls / /tmp')
+        response = pop_command_response(testbot, until="Fan-out finished")
+    finally:
+        plugin.EXECUTABLE_CONFIGS['testls'] = testls
+    assert "[ok] / RC: 0" in response
+    assert "[FAIL] /tmp error" in response
+    assert "filter blew up" in response
+    assert "1 ok, 1 failed" in response
+
+
+def test_output_pipeline(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    pipeline_class = type(plugin.EXECUTABLE_CONFIGS['testls'].filters)
+
+    def run(filters, text):
+        return "".join(pipeline_class.compile(filters).apply(line + "\n" for line in text.splitlines()))
+
+    log = "INFO start\nDEBUG noise\nERROR bad\nDEBUG noise\nINFO done"
+    assert run("grep INFO", log) == "INFO start\nINFO done\n"
+    assert run("grep -v DEBUG | tail 2", log) == "ERROR bad\nINFO done\n"
+    assert run(["grep -i error"], log) == "ERROR bad\n"
+    assert run("head 2", log) == "INFO start\nDEBUG noise\n"
+    assert run("grep DEBUG | uniq", log) == "   2 DEBUG noise\n"
+    assert run("cols 2", "a b c\nd e f") == "b\ne\n"
+    assert run("cols -d , 3,1", "a,b,c\nd,e,f") == "c,a\nf,d\n"
+    assert run("json $.items[*].name", '{"items": [{"name": "one"}, {"name": "two"}]}') == "one\ntwo\n"
+    assert run("json $.items[1]", '{"items": [{"name": "one"}, {"name": "two"}]}') == '{"name": "two"}\n'
+    assert run("json .id", '{"id": 1}\n{"id": 2}') == "1\n2\n"
+    assert "Unable to parse output as json" in run("json .id", "not json")
+    # a quoted | is part of the filter rather than a new one
+    assert run("grep 'x|y'", "x\nz\ny") == "x\ny\n"
+
+    assert pipeline_class.split_pipes("/ -l | grep 'x|y' | head") == ["/ -l", "grep 'x|y'", "head"]
+    assert pipeline_class.split_pipes('"a|b" \\| c') == ['"a|b" \\| c']
+    assert not pipeline_class.compile([])
+    for bad_filters in ["sort", "head lots", "grep", "grep -x foo", "grep (", "cols a", "cols 0", "json",
+                        "json $.items[", "uniq extra", "head |", "cols -d '' 1"]:
+        with pytest.raises(ValueError):
+            pipeline_class.compile(bad_filters)
+
+    with pytest.raises(ValidationException):
+        plugin._compile_command_spec("bad", {'bin_path': "/bin/ls", 'filters': "sort"})
+
+
+def test_run_command_filters(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    testbot.push_message('!testls / | grep ^b | head 1')
+    response = pop_command_response(testbot)
+    assert "bin" in response
+    assert "boot" not in response
+
+    testbot.push_message('!testls / | sort')
+    assert "Invalid output filter: unknown filter sort" in testbot.pop_message()
+
+    testls = plugin.EXECUTABLE_CONFIGS['testls']
+    plugin.EXECUTABLE_CONFIGS['testls'] = plugin._compile_command_spec("testls", {'bin_path': "/bin/ls",
+                                                                                  'filters': ["grep ^b"]})
+    try:
+        # filters from the config run first, then the ones from the invocation
+        testbot.push_message('!testls / | tail 1')
+        response = pop_command_response(testbot)
+    finally:
+        plugin.EXECUTABLE_CONFIGS['testls'] = testls
+    assert "boot" in response
+    assert "bin\n" not in response
+
+    class BrokenFilters:
+        def apply(self, lines):
+            next(iter(lines))
+            raise RuntimeError("filter blew up")
+
+    # a filter that raises doesn't leave the command running behind it
+    plugin_module = sys.modules[type(plugin).__module__]
+    sleep_spec = plugin._compile_command_spec("sleep", {'bin_path': "/bin/sh"})
+    command = plugin._spawn_command(sleep_spec, "-c 'echo started; sleep 30'", plugin_module.NOOP_SPAN)
+    with pytest.raises(RuntimeError):
+        plugin._wait_for_command(command, sleep_spec, BrokenFilters(), plugin_module.NOOP_SPAN)
+    assert command.subprocess.signalstatus == signal.SIGKILL
+
+    # output is read in chunks and split into lines by us, including a last line with no newline
+    command = plugin._spawn_command(sleep_spec, "-c 'seq 1 50000; printf end'", plugin_module.NOOP_SPAN)
+    output, output_bytes = plugin._wait_for_command(command, sleep_spec, plugin_module.OutputPipeline.compile("tail 2"),
+                                                    plugin_module.NOOP_SPAN)
+    assert output == "50000\nend"
+    assert output_bytes == len("\n".join(str(number) for number in range(1, 50001))) + len("\nend")
+
+
+def test_warm_restart(testbot, mocker, tmp_path):
+    plugin_manager = testbot.bot.plugin_manager
+    plugin = plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    help_text = plugin.EXECUTABLE_CONFIGS['testoverwrite'].help
+    temp_path = plugin.TEMP_PATH
+
+    plugin_manager.deactivate_plugin('ChatOpsAnything')
+    # the checkpoint keeps our tempdir around and has the help we probed
+    assert temp_path.is_dir()
+    with open(plugin.config['STATE_PATH'], 'r') as stream:
+        state = json.load(stream)
+    assert state['help']['/bin/dd']['help'] == help_text
+    assert state['temp_path'] == str(temp_path)
+
+    mocker.spy(plugin, "_get_help")
+    plugin_manager.activate_plugin('ChatOpsAnything')
+    # nothing changed, so nothing had to be probed again
+    assert plugin._get_help.call_count == 0
+    assert plugin.EXECUTABLE_CONFIGS['testoverwrite'].help == help_text
+    testbot.push_message('!testls /')
+    assert "Command RC: 0" in pop_command_response(testbot)
+
+    # with warm restarts turned off, the next activation still cleans up the tempdir the checkpoint kept around
+    plugin_manager.deactivate_plugin('ChatOpsAnything')
+    assert temp_path.is_dir()
+    new_config = dict(plugin.config, TEMP_PATH=str(tmp_path), TMP_CLEANUP=False, WARM_RESTART=False)
+    plugin_manager.set_plugin_configuration('ChatOpsAnything', new_config)
+    try:
+        plugin_manager.activate_plugin('ChatOpsAnything')
+    finally:
+        plugin_manager.set_plugin_configuration('ChatOpsAnything', None)
+    assert plugin.TEMP_PATH != temp_path
+    assert plugin._get_help.call_count > 0
+    assert not temp_path.exists()
+    assert not Path(plugin.config['STATE_PATH']).exists()
+
+
+@responses.activate
+def test_fetch_executable_reuses_checkpoint(testbot, mocker, tmp_path):
+    # the server says our copy is current if we send the etag it gave us
+    responses.add(responses.GET, "https://fakeurl.fakesite.com/fakefile", status=304,
+                  match=[responses.matchers.header_matcher({'If-None-Match': '"v1"'})])
+    responses.add(responses.GET, "https://fakeurl.fakesite.com/fakefile", status=200, body="new file")
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('ChatOpsAnything')
+    mocker.patch.object(plugin, "_download_executable")
+    plugin._download_executable.return_value = "/tmp/fake/executable"
+
+    old_download = tmp_path / "fakefile"
+    old_download.write_text("file")
+    plugin.CHECKPOINT = plugin._empty_state()
+    plugin.CHECKPOINT['downloads']["https://fakeurl.fakesite.com/fakefile"] = {
+        'name': "fakefile", 'path': str(old_download), 'fingerprint': plugin._fingerprint(old_download),
+        'validators': {'etag': '"v1"', 'last_modified': None}}
+    plugin.CHECKPOINT['help'][str(old_download)] = {'help': "fake help",
+                                                    'fingerprint': plugin._fingerprint(old_download)}
+
+    # the checkpointed download is unchanged here and upstream, so it gets moved into our tempdir rather than
+    # downloaded
+    file_path = plugin._fetch_executable("https://fakeurl.fakesite.com/fakefile", "fakefile")
+    assert file_path == os.path.join(plugin.TEMP_PATH, "fakefile")
+    assert Path(file_path).read_text() == "file"
+    assert not old_download.exists()
+    assert plugin._download_executable.call_count == 0
+    assert plugin.RESOLVED_STATE['downloads']["https://fakeurl.fakesite.com/fakefile"]['path'] == file_path
+    assert plugin.RESOLVED_STATE['downloads']["https://fakeurl.fakesite.com/fakefile"]['validators']['etag'] == '"v1"'
+    # its cached help moved with it, so it isn't probed again
+    mocker.patch.object(plugin, "_get_help")
+    assert plugin._probe_help(Path(file_path)) == "fake help"
+    assert plugin._get_help.call_count == 0
+
+    # once the file is gone, we have to download it again
+    os.remove(file_path)
+    assert plugin._fetch_executable("https://fakeurl.fakesite.com/fakefile", "fakefile") == "/tmp/fake/executable"
+    assert plugin._download_executable.call_count == 1
+
+    # same if it's there but can't be moved into our tempdir
+    old_download.write_text("file")
+    plugin.CHECKPOINT['downloads']["https://fakeurl.fakesite.com/fakefile"]['fingerprint'] = \
+        plugin._fingerprint(old_download)
+    mocker.patch.object(sys.modules[type(plugin).__module__], "move", side_effect=PermissionError("read only"))
+    assert plugin._fetch_executable("https://fakeurl.fakesite.com/fakefile", "fakefile") == "/tmp/fake/executable"
+    assert plugin._download_executable.call_count == 2
+
+    # a download that changed upstream, or that we have no validators for, is downloaded again
+    mocker.stopall()
+    mocker.patch.object(plugin, "_download_executable", return_value="/tmp/fake/executable")
+    for etag in ['"v2"', None]:
+        plugin.CHECKPOINT['downloads']["https://fakeurl.fakesite.com/fakefile"]['validators']['etag'] = etag
+        assert plugin._fetch_executable("https://fakeurl.fakesite.com/fakefile", "fakefile") == "/tmp/fake/executable"
+    assert plugin._download_executable.call_count == 2
+    assert old_download.exists()
+    plugin.CHECKPOINT = plugin._empty_state()